@@ -0,0 +1,97 @@
+#================================================================================
+#
+# Copyright (C) 2020 Institute of Theoretical Astrophysics, University of Oslo.
+#
+# This file is part of Commander3.
+#
+# Commander3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Commander3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Commander3. If not, see <https://www.gnu.org/licenses/>.
+#
+#================================================================================
+
+# Costs of the scans of a filelist and their assignment to the processes of
+# commander, which split the scans between them by the weights in the
+# filelist
+
+import heapq
+import numpy as np
+
+#bytes a sample of a detector field takes in commander once decoded
+decodedBytes = 4
+
+#returns the cost of every pid of a catalog: the bytes its detector fields
+#take once decoded, ntod x detectors x fields x decodedBytes
+def scan_costs(catalog):
+    ndets = np.array([len(dets.split(',')) if len(dets) > 0 else 0 for dets in catalog['dets']])
+    nfields = np.array([len(fields.split(',')) if len(fields) > 0 else 0 for fields in catalog['fields']])
+    return np.asarray(catalog['ntod'], dtype=np.float64) * ndets * nfields * decodedBytes
+
+#assigns the scans of the given costs to ranks processes, largest first and
+#each to the process with the least cost so far (longest processing time
+#first), returning the process of every scan
+def lpt_assignment(costs, ranks):
+    costs = np.asarray(costs, dtype=np.float64)
+    assignment = np.zeros(len(costs), dtype=np.int64)
+    heap = [(0.0, rank) for rank in range(ranks)]
+    for i in np.argsort(-costs, kind='stable'):
+        load, rank = heapq.heappop(heap)
+        assignment[i] = rank
+        heapq.heappush(heap, (load + costs[i], rank))
+    return assignment
+
+#returns the process of every scan as chosen by get_scan_ids in
+#comm_tod_mod.f90 from the weights and the spin axes (theta, phi) of the
+#filelist: the scans are ordered by the angle of their spin axis from that
+#of the first scan, and dealt out in runs of about the mean weight per
+#process, from the last process down. The arithmetic follows the fortran
+#code, including its normalization of the symmetry axis
+def commander_assignment(weights, spinpos, ranks):
+    weights = np.asarray(weights, dtype=np.float64)
+    theta, phi = np.asarray(spinpos, dtype=np.float64).T
+    axes = np.array([np.sin(theta)*np.cos(phi), np.sin(theta)*np.sin(phi), np.cos(theta)]).T
+    n = len(weights)
+
+    v = np.cross(axes[0], axes[1:])
+    v[v[:,2] < 0] *= -1
+    norms = np.sqrt(np.sum(v*v, axis=1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        v0 = np.sum(v[norms > 0]/norms[norms > 0,None], axis=0)
+        v0 = v0/np.sqrt(v0*v0)
+        sid = np.arccos(np.clip(axes @ axes[0], -1, 1))
+        sid[np.sum(np.cross(axes[0], axes)*v0, axis=1) < 0] *= -1
+    order = np.argsort(sid, kind='stable')
+
+    assignment = np.full(n, -1, dtype=np.int64)
+    total = np.sum(weights)
+    j = 0
+    for rank in range(ranks - 1, 0, -1):
+        w = np.sum(weights[assignment == rank])
+        while w < total/ranks and j < n:
+            assignment[order[j]] = rank
+            w += weights[order[j]]
+            if w > 1.2*total/ranks:
+                #large scans go to the next process
+                assignment[order[j]] = rank - 1
+                w -= weights[order[j]]
+            j += 1
+    assignment[order[j:]] = 0
+    return assignment
+
+#the cost of every process
+def rank_loads(costs, assignment, ranks):
+    return np.bincount(assignment, weights=costs, minlength=ranks)
+
+#the largest cost of a process over the mean, 1 for a perfect balance
+def imbalance(costs, assignment, ranks):
+    loads = rank_loads(costs, assignment, ranks)
+    return np.max(loads)/np.mean(loads)
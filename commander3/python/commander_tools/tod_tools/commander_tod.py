@@ -21,31 +21,184 @@
 
 import h5py
 import commander_tools.tod_tools.huffman as huffman
+import commander_tools.tod_tools.rans as rans
+import commander_tools.tod_tools.flags as flags
+import commander_tools.tod_tools.balance as balance
+import commander_tools.tod_tools.summary as summary
 import healpy as hp
 import numpy as np
 import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from collections.abc import Mapping
+import threading
+import hashlib
+import io
+import json
 import os
+import queue
 import sys
+import time
+
+#entropy coders that can end a compression chain in place of huffman, by
+#name. A coder is built from the arguments of its step, and codes the
+#differenced data of a field into a self contained stream with
+#Encode(array), which Decode(bytes) inverts. Only huffman streams are read
+#by commander itself
+entropyCoders = {'rans':rans.rANS}
+
+#compression steps coded with per pid huffman dictionaries. canonical steps
+#use length limited canonical codes of at most maxLength bits, which are
+#stored as code lengths only and are not read by commander itself
+huffmanSteps = ['huffman', 'canonical']
+
+#columns of the scan catalogs and their types. fields and compression are
+#the comma separated detector field names and compression chains of a pid
+catalogColumns = [('pid', np.int64), ('od', np.int64), ('fileName', np.str_), ('ntod', np.int64), ('load0', np.float64), ('load1', np.float64), ('mjdStart', np.float64), ('mjdEnd', np.float64), ('nbytes', np.int64), ('dets', np.str_), ('fields', np.str_), ('compression', np.str_)]
+
+#compression steps acting on every sample on its own, which are applied
+#blockwise together with the differencing when they lead to a huffman step
+elementwiseSteps = ['dtype', 'sigma', 'digitize']
+
+#samples per block of fused_deltas
+_fuseSamples = 1 << 16
+
+#compression steps for flag fields that end a chain and store the field in a
+#layout of their own: 'rle' as (start, length, value) runs and 'packbits' as
+#one bit array per flag bit in use (or per bit of a 'bits' entry). Both read
+#only what a slice of the field needs, and are not read by commander itself
+flagSteps = ['rle', 'packbits']
+
+#pids buffered with begin_chunk are written to a group of this suffix and
+#moved to their own name once complete, after which they are recorded in
+#the manifest of the file, see write_pid. A file with a manifest was not
+#finalized, and init_file resumes it from the pids the manifest holds
+_partialSuffix = '.partial'
+
+#suffixes of the datasets kept next to a huffman field rather than in its
+#attributes, which hdf5 limits to 64 KiB: the sync points of a field with a
+#sync step as (bits, values) records, and the samples escaped from a shared
+#dictionary as (index, delta) records. They are not fields of their own
+sideSuffixes = {'sync':'_sync', 'escape':'_escape'}
+
+#datasets of at most this many bytes are written by write_chunk with a
+#compact layout, inside their object header, which saves the separate data
+#block and the read that fetches it
+_compactBytes = 8192
+
+#dataset creation properties set once for write_chunk: compact and
+#contiguous layouts without modification times, so rewriting a pid gives
+#the same bytes, and links creating the groups above them
+_compactDcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+_compactDcpl.set_layout(h5py.h5d.COMPACT)
+_compactDcpl.set_obj_track_times(False)
+_contiguousDcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+_contiguousDcpl.set_layout(h5py.h5d.CONTIGUOUS)
+_contiguousDcpl.set_obj_track_times(False)
+_groupLcpl = h5py.h5p.create(h5py.h5p.LINK_CREATE)
+_groupLcpl.set_create_intermediate_group(True)
 
 class commander_tod:
 
-    def __init__(self, outPath, version=None, dicts=None, overwrite=False):
+    def __init__(self, outPath, version=None, dicts=None, overwrite=False, threads=1, treeCacheSize=64, catalogs=None, memmap=False, writeQueue=0):
         self.outPath = outPath
         self.filelists = dicts
+        #catalog rows of the finalized files by frequency and file name,
+        #which make_catalogs merges into the catalogs of outPath
+        self.catalogs = catalogs
+        #version of the file layout, stored as /common/version. What a file
+        #is made from is recorded by its digest instead, see compute_version
         self.version = version
-        #TODO: something with the version number
         self.overwrite = overwrite
+        #number of threads used to build and apply the huffman trees of a pid
+        self.threads = threads
+        #least recently used cache of the huffman trees read from the files
+        self.treeCache = OrderedDict()
+        self.treeCacheSize = treeCacheSize
+        self.treeCacheLock = threading.Lock()
+        self.treeCacheHits = 0
+        self.treeCacheMisses = 0
+        #mission wide huffman codecs and the largest fraction of escaped
+        #samples a pid may have before it falls back to a tree of its own,
+        #keyed by (freq, dictNum)
+        self.sharedDicts = {}
+        #buffer of every thread that compressed fields are read into
+        self.readBuffers = threading.local()
+        #whether uncompressed fields are written contiguous even when small,
+        #and read as read only memory maps of the file, which share the page
+        #cache between processes instead of copying
+        self.memmap = memmap
+        self.fieldMaps = {}
+        #fields of the pid opened by begin_chunk, by name, until write_chunk
+        self.chunkBuffer = None
+        self.chunkPid = None
+        #number of buffered pids that may wait for a writer thread while the
+        #next ones are encoded. With 0 finalize_chunk writes them itself.
+        #The arrays given to add_field must not change until they are written
+        self.writeQueue = writeQueue
+        self.writer = None
+        self.writeItems = None
+        self.writeError = None
+        #pids written from the chunk buffer, the seconds spent writing them
+        #and the seconds the encoding was blocked waiting for the writes,
+        #updated by the writer thread too
+        self.writeStats = {'pids':0, 'write':0.0, 'blocked':0.0}
+        self.writeStatsLock = threading.Lock()
+
+    #objects are sent to worker processes without the lock, cached trees,
+    #read buffers and writer thread
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['treeCache'] = OrderedDict()
+        state['fieldMaps'] = {}
+        state['writer'] = None
+        state['writeItems'] = None
+        del state['treeCacheLock']
+        del state['writeStatsLock']
+        del state['readBuffers']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.treeCacheLock = threading.Lock()
+        self.writeStatsLock = threading.Lock()
+        self.readBuffers = threading.local()
 
     #initilizes a file for a single od
     def init_file(self, freq, od, mode='r'):
+        self.flush_writes()
         self.huffDict = {}
+        self.huffModes = {}
+        self.syncSteps = {}
+        #attributes of fields that are not written yet, by field name
         self.attrDict = {}
+        #arguments of the hdf5 steps of fields that are not written yet
+        self.creationOptions = {}
+        #statistics of the fields added with stats since the last pid was
+        #finalized, by field name, see add_field
+        self.fieldStats = {}
         self.encodings = {}
         self.pids = {}
+        self.chunkBuffer = None
+        self.chunkPid = None
+        #memory maps of the fields of the file read by map_field, by name
+        self.fieldMaps = {}
+        #what the file is made from and its digest, see set_provenance, and
+        #the digest of the file as it was found
+        self.provenance = None
+        self.digest = None
+        self.storedDigest = None
 
         self.od = od
         self.freq = freq
-        self.outName = os.path.join(self.outPath, 'LFI_0' + str(freq) + '_' + str(od).zfill(6) + '.h5')
+        self.outName = self.file_name(freq, od)
+
+        if mode == 'w':
+            #trees cached from an earlier version of this file are stale
+            with self.treeCacheLock:
+                for key in list(self.treeCache.keys()):
+                    if key[0] == self.outName:
+                        del self.treeCache[key]
 
         self.exists = False
         if os.path.exists(self.outName):
@@ -53,89 +206,496 @@ class commander_tod:
         if mode == 'w':
             if self.exists and self.overwrite:
                 os.remove(self.outName)
+                self.exists = False
+            if not self.exists and os.path.exists(self.manifest_name()):
+                os.remove(self.manifest_name())
             try:
                 self.outFile = h5py.File(self.outName, 'a')
 
                 if self.exists and not self.overwrite:
-                    for pid in self.load_field('/common/pids'):
-                        loadBalance = self.load_field('/' + str(pid).zfill(6) + '/common/load')
-                        self.pids[pid] = str(float(loadBalance[0])) + ' ' + str(float(loadBalance[1]))
-            except (KeyError, OSError):
-                if(hasattr(self, 'outFile')):
-                    self.outFile.close()
-                os.remove(self.outName)
-                self.exists = False
-                self.outFile = h5py.File(self.outName, 'a')
+                    if os.path.exists(self.manifest_name()):
+                        self.resume_file()
+                    else:
+                        for pid in self.load_field('/common/pids'):
+                            loadBalance = self.load_field('/' + str(pid).zfill(6) + '/common/load')
+                            self.pids[pid] = str(float(loadBalance[0])) + ' ' + str(float(loadBalance[1]))
+                        if '/common/digest' in self.outFile:
+                            self.storedDigest = self.outFile['/common/digest'][()].decode()
+            except (KeyError, OSError, ValueError):
+                self.reset_file()
         
         if mode == 'r':
             if not self.exists:
                 raise OSError('Cannot find file ' + self.outName)
             self.outFile = h5py.File(self.outName, 'r')
             
+    def file_name(self, freq, od):
+        return os.path.join(self.outPath, 'LFI_0' + str(freq) + '_' + str(od).zfill(6) + '.h5')
+
+    #replaces the file being written by an empty one
+    def reset_file(self):
+        if(hasattr(self, 'outFile')):
+            self.outFile.close()
+        os.remove(self.outName)
+        if os.path.exists(self.manifest_name()):
+            os.remove(self.manifest_name())
+        self.exists = False
+        self.pids = {}
+        self.encodings = {}
+        self.storedDigest = None
+        self.outFile = h5py.File(self.outName, 'a')
+
+    #the pids committed to a file that is not finalized yet, with their
+    #load balancing numbers, the encodings their compression needs and the
+    #digest of the file
+    def manifest_name(self):
+        return self.outName + '.manifest'
+
+    def manifest(self):
+        return {'pids':{str(pid):load for pid, load in self.pids.items()}, 'encodings':{name:np.asarray(value).tolist() for name, value in self.encodings.items()}, 'digest':self.digest}
+
+    #replaces the manifest in one step, so it is never found half written
+    def write_manifest(self, manifest):
+        tmpName = self.manifest_name() + '.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmpName, self.manifest_name())
+
+    #picks up a file whose conversion was interrupted: the pids in its
+    #manifest are kept and everything written after them is removed, apart
+    #from the shared trees they link to, so the conversion carries on with
+    #the first pid missing. The file is not counted as existing, so it is
+    #finalized again
+    def resume_file(self):
+        with open(self.manifest_name()) as f:
+            manifest = json.load(f)
+        self.pids = {int(pid):load for pid, load in manifest['pids'].items()}
+        self.encodings = manifest['encodings']
+        self.storedDigest = manifest.get('digest')
+        for name in list(self.outFile.keys()):
+            if name == 'common':
+                for commonName in list(self.outFile['common'].keys()):
+                    if not commonName.startswith('huff'):
+                        del self.outFile['common/' + commonName]
+            elif not (name.isdigit() and int(name) in self.pids):
+                del self.outFile[name]
+        self.exists = False
+
     #File Writing functions
-    def add_field(self, fieldName, data, compression=None):
+    #stats is None, or a dict of the statistics to gather from the raw
+    #samples of the field: count, min, max, mean and variance always, the
+    #fraction of samples flagged by any bit of 'flagMask' and, with 'unique',
+    #the number of distinct values. finalize_chunk stores them in the stats
+    #table of the pid, see summary.statColumns
+    def add_field(self, fieldName, data, compression=None, stats=None):
+        if stats is not None:
+            self.fieldStats[fieldName] = summary.summarize(data, stats)
         writeField = True
         if(compression is not None and compression is not []):
             compInfo = ''
             if(len(compression) == 2 and type(compression[0]) == str):
                 #catch case with only one compression argument not in array
                 compression = [compression]
-            for compArr in compression:
+            steps = [compArr[0] for compArr in compression]
+            if 'hdf5' in steps and any(step in huffmanSteps or step in entropyCoders.keys() for step in steps):
+                raise ValueError('The hdf5 step of ' + fieldName + ' needs an array to filter, not a huffman or entropy coded stream')
+            #number of leading elementwise steps, which are applied together
+            #with the differencing of a huffman step following them
+            fused = 0
+            while fused < len(steps) and steps[fused] in elementwiseSteps:
+                fused += 1
+            if fused == len(steps) or steps[fused] not in huffmanSteps:
+                fused = 0
+            for i, compArr in enumerate(compression):
                 compInfo += compArr[0] + ' '
-                if compArr[0] == 'dtype':
-                    data=np.array(data, dtype=compArr[1]['dtype'])
-
-                elif compArr[0] == 'sigma':
-                    data = np.int32(compArr[1]['nsigma'] * data/(compArr[1]['sigma0']))
-                    metaName = '/common/n' + fieldName.split('/')[-1] + 'sigma'
-                    self.encodings[metaName] = compArr[1]['nsigma']
-                    self.add_attribute(fieldName, 'nsigma', compArr[1]['nsigma'])
-                    self .add_attribute(fieldName, 'sigma0', compArr[1]['sigma0'])
-
-                elif compArr[0] == 'digitize':
-                    bins = np.linspace(compArr[1]['min'], compArr[1]['max'], num = compArr[1]['nbins'])
-                    data = np.digitize(data, bins)
-                    metaName = '/common/n' + fieldName.split('/')[-1]
-                    self.add_encoding(metaName, compArr[1]['nbins'])
-                    self.add_attribute(fieldName, 'min', compArr[1]['min'])
-                    self.add_attribute(fieldName, 'max', compArr[1]['max'])
-                    self.add_attribute(fieldName, 'nbins', compArr[1]['nbins'])
-                
-
-                elif compArr[0] == 'huffman':
+                if i < fused:
+                    continue
+                if compArr[0] in huffmanSteps:
+                    self.add_huffman_mode(compArr)
                     dictNum = compArr[1]['dictNum']
                     if dictNum not in self.huffDict.keys():
                         self.huffDict[dictNum] = {}
-                    delta = np.diff(data)
-                    delta = np.insert(delta, 0, data[0])
-                    self.huffDict[dictNum][fieldName] = delta
+                    self.huffDict[dictNum][fieldName] = self.fused_deltas(fieldName, data, compression[:fused])
                     self.add_attribute(fieldName, 'huffmanDictNumber', dictNum)
+                    self.add_sync_step(fieldName, compArr[1])
                     writeField = False 
 
+                elif compArr[0] in entropyCoders.keys():
+                    coder = entropyCoders[compArr[0]](**compArr[1])
+                    data = np.asarray(data)
+                    #the samples decode to int64 and are cast back to this
+                    self.add_attribute(fieldName, compArr[0] + 'Dtype', data.dtype.str)
+                    if data.dtype.kind == 'u' and len(data) > 0 and data.max() <= np.iinfo(np.int64).max:
+                        #differences of unsigned samples would wrap around
+                        data = data.astype(np.int64)
+                    elif data.dtype.kind == 'u' and len(data) > 0:
+                        raise ValueError(fieldName + ' has samples too large for ' + compArr[0])
+                    elif data.dtype.kind not in 'iu':
+                        raise ValueError(compArr[0] + ' only codes integers, add a digitize or sigma step to code ' + fieldName + ' of ' + str(data.dtype))
+                    data = np.void(coder.Encode(np.diff(data, prepend=0)))
+
+                elif compArr[0] == 'hdf5':
+                    #an hdf5 step anywhere in a chain stores the field chunked
+                    #and filtered by hdf5, see creation_options. Its options
+                    #are checked here rather than when the field is written
+                    self.creation_options(data, compArr[1])
+                    self.creationOptions[fieldName] = compArr[1]
+
                 else:
-                    raise ValueError('Compression type ' + compArr[0] + ' is not a recognized compression')
+                    data = self.compress(fieldName, data, compArr)
             self.add_attribute(fieldName, 'compression', compInfo)
             #print("adding " + compInfo + ' to ' + fieldName)
 
-        if writeField:
-            try:
-                self.outFile.create_dataset(fieldName, data=data)
-            except OSError as e:
-                if self.overwrite:
-                    del self.outFile[fieldName]
-                    self.outFile.create_dataset(fieldName, data=data)
-                else:
-                    raise OSError(e)
-            for attr in self.attrDict.copy().keys():
-                fName, attrName = attr.split('@')
-                if fName == fieldName:
-                    self.add_attribute(fieldName, attrName, self.attrDict.pop(attr))
+        if writeField and self.chunkBuffer is not None:
+            self.chunkBuffer[fieldName] = data
+        elif writeField:
+            self.write_field(fieldName, data, self.creationOptions.pop(fieldName, None), self.attrDict.pop(fieldName, {}))
+
+    #creates the dataset of a field, with the arguments of its hdf5 step, and
+    #the attributes it was given before it existed
+    def write_field(self, fieldName, data, hdf5Args=None, attrs={}):
+        options = self.creation_options(data, hdf5Args)
+        try:
+            dset = self.outFile.create_dataset(fieldName, data=data, **options)
+        except OSError as e:
+            if self.overwrite:
+                del self.outFile[fieldName]
+                dset = self.outFile.create_dataset(fieldName, data=data, **options)
+            else:
+                raise OSError(e)
+        if len(options) > 0:
+            #the layout and filters hdf5 ended up using
+            dset.attrs['hdf5Chunks'] = dset.chunks if dset.chunks is not None else ()
+            dset.attrs['hdf5Filter'] = dset.compression if dset.compression is not None else 'none'
+            dset.attrs['hdf5Shuffle'] = dset.shuffle
+        for attrName, value in attrs.items():
+            dset.attrs[attrName] = value
+
+    #maps the arguments of an hdf5 compression step to h5py dataset
+    #creation options: 'chunks', the number of samples per chunk (or True to
+    #let h5py choose), a 'filter' of 'gzip' (at 'level') or 'lzf', and
+    #'shuffle' to store the bytes of the samples by significance. lzf
+    #filtered fields are only readable through h5py, not by commander
+    @staticmethod
+    def creation_options(data, hdf5Args):
+        if hdf5Args is None:
+            return {}
+        data = np.asarray(data)
+        if data.size == 0 or data.ndim == 0:
+            #empty and scalar datasets cannot be chunked
+            return {}
+        options = {}
+        chunks = hdf5Args.get('chunks', True)
+        if chunks is not True and chunks is not None:
+            chunks = np.atleast_1d(chunks)
+            options['chunks'] = tuple(int(min(c, n)) for c, n in zip(chunks, data.shape)) + data.shape[len(chunks):]
+        else:
+            options['chunks'] = True
+        filt = hdf5Args.get('filter')
+        if filt not in [None, 'none', 'gzip', 'lzf']:
+            raise ValueError('Unknown hdf5 filter ' + str(filt))
+        if filt not in [None, 'none']:
+            options['compression'] = filt
+            if filt == 'gzip' and 'level' in hdf5Args:
+                options['compression_opts'] = hdf5Args['level']
+        if hdf5Args.get('shuffle', False):
+            options['shuffle'] = True
+        return options
+
+    #adds a huffman compressed field without holding its data in memory.
+    #chunks is a function returning a fresh iterator over consecutive pieces
+    #of the data. It is traversed here to accumulate the symbol counts, and
+    #again in finalize_chunk where the field is encoded piece by piece, so
+    #only the compressed stream is ever held in memory. With stats (see
+    #add_field) it is traversed once more for the statistics
+    def add_field_chunks(self, fieldName, chunks, compression, stats=None):
+        if(len(compression) == 2 and type(compression[0]) == str):
+            compression = [compression]
+        if compression[-1][0] not in huffmanSteps:
+            raise ValueError('Chunked fields must end with a huffman compression step')
+        self.add_huffman_mode(compression[-1])
+        if stats is not None:
+            fieldStats = summary.field_summary(stats.get('flagMask'), stats.get('unique', False))
+            for data in chunks():
+                fieldStats.add(data)
+            self.fieldStats[fieldName] = fieldStats
+
+        hist = huffman.Histogram()
+        for delta in self.chunk_deltas(fieldName, chunks, compression[:-1]):
+            hist.Add(delta)
+
+        dictNum = compression[-1][1]['dictNum']
+        if dictNum not in self.huffDict.keys():
+            self.huffDict[dictNum] = {}
+        self.huffDict[dictNum][fieldName] = (chunks, compression[:-1], hist)
+        self.add_attribute(fieldName, 'huffmanDictNumber', dictNum)
+        self.add_sync_step(fieldName, compression[-1][1])
+        self.add_attribute(fieldName, 'compression', ''.join(compArr[0] + ' ' for compArr in compression))
+
+    #all fields of a dictionary must use the same type of code
+    def add_huffman_mode(self, huffArr):
+        dictNum = huffArr[1]['dictNum']
+        mode = (huffArr[0], huffArr[1].get('maxLength'))
+        if self.huffModes.setdefault(dictNum, mode) != mode:
+            raise ValueError('Fields of huffman dictionary ' + str(dictNum) + ' use different codes ' + str(self.huffModes[dictNum]) + ' and ' + str(mode))
+
+    #a huffman step with a 'sync' entry stores the bit offset and running
+    #value of every sync-th sample in the side dataset of the field, and the
+    #number of samples as huffmanSyncLength, so the field can be decoded from
+    #the middle or in parallel
+    def add_sync_step(self, fieldName, huffArgs):
+        if 'sync' in huffArgs:
+            self.syncSteps[fieldName] = huffArgs['sync']
+            self.add_attribute(fieldName, 'huffmanSyncStep', huffArgs['sync'])
+
+    #applies the compression steps to every piece of a chunked field and
+    #yields the differences, continued across piece boundaries
+    def chunk_deltas(self, fieldName, chunks, compression):
+        last = 0
+        for data in chunks():
+            for compArr in compression:
+                data = self.compress(fieldName, data, compArr)
+            if len(data) == 0:
+                continue
+            yield np.diff(data, prepend=last)
+            last = data[-1]
+
+    #returns the differences of data after the elementwise steps of
+    #compression, starting from data[0], as the huffman steps store them.
+    #The steps and differences are applied _fuseSamples samples at a time,
+    #writing straight into the result, so the only array of the size of the
+    #field made is the result itself
+    def fused_deltas(self, fieldName, data, compression):
+        n = len(data)
+        head = np.asarray(data[:1])
+        for compArr in compression:
+            head = self.compress(fieldName, head, compArr)
+        delta = np.empty(n, dtype=head.dtype)
+        prev = None
+        for start in range(0, n, _fuseSamples):
+            block = np.asarray(data[start:start + _fuseSamples])
+            for compArr in compression:
+                block = self.compress(fieldName, block, compArr)
+            out = delta[start:start + len(block)]
+            np.subtract(block[1:], block[:-1], out=out[1:])
+            if prev is None:
+                out[0] = block[0]
+            else:
+                np.subtract(block[:1], prev, out=out[:1])
+            prev = block[-1:]
+        return delta
+
+    #applies a single (non huffman) compression step to data
+    def compress(self, fieldName, data, compArr):
+        if compArr[0] == 'dtype':
+            data=np.array(data, dtype=compArr[1]['dtype'])
+
+        elif compArr[0] == 'sigma':
+            data = np.int32(compArr[1]['nsigma'] * data/(compArr[1]['sigma0']))
+            metaName = '/common/n' + fieldName.split('/')[-1] + 'sigma'
+            self.encodings[metaName] = compArr[1]['nsigma']
+            self.add_attribute(fieldName, 'nsigma', compArr[1]['nsigma'])
+            self .add_attribute(fieldName, 'sigma0', compArr[1]['sigma0'])
+
+        elif compArr[0] == 'digitize':
+            bins = np.linspace(compArr[1]['min'], compArr[1]['max'], num = compArr[1]['nbins'])
+            data = np.digitize(data, bins)
+            metaName = '/common/n' + fieldName.split('/')[-1]
+            self.add_encoding(metaName, compArr[1]['nbins'])
+            self.add_attribute(fieldName, 'min', compArr[1]['min'])
+            self.add_attribute(fieldName, 'max', compArr[1]['max'])
+            self.add_attribute(fieldName, 'nbins', compArr[1]['nbins'])
+
+        elif compArr[0] == 'rle':
+            data = flags.encode_runs(data)
+
+        elif compArr[0] == 'packbits':
+            self.add_attribute(fieldName, 'packedLength', len(data))
+            self.add_attribute(fieldName, 'packedDtype', np.asarray(data).dtype.str)
+            data, bits = flags.pack_bits(data, compArr[1].get('bits'))
+            self.add_attribute(fieldName, 'packedBits', np.array(bits, dtype=np.int64))
+
+        else:
+            raise ValueError('Compression type ' + compArr[0] + ' is not a recognized compression')
+        return data
 
     def add_attribute(self, fieldName, attrName, data):
+        if fieldName in self.attrDict or (self.chunkBuffer is not None and fieldName in self.chunkBuffer):
+            self.attrDict.setdefault(fieldName, {})[attrName] = data
+            return
         try:
             self.outFile[fieldName].attrs[attrName] = data
         except KeyError as k:
-            self.attrDict[fieldName + '@' + attrName] = data   
+            self.attrDict[fieldName] = {attrName:data}
+
+    #buffers the fields and attributes of pid in memory from here on, so
+    #write_chunk (called by finalize_chunk) creates them all in one pass
+    #instead of one create_dataset and attribute lookup per field
+    def begin_chunk(self, pid):
+        if self.chunkBuffer is not None:
+            raise ValueError('Chunk ' + str(self.chunkPid) + ' is still being buffered')
+        self.chunkBuffer = {}
+        self.chunkPid = pid
+
+    #stops buffering and writes the pid buffered since begin_chunk, or with
+    #a writeQueue hands it to the writer thread together with its attributes,
+    #hdf5 steps and manifest, so the next pid is encoded meanwhile
+    def write_chunk(self):
+        if self.chunkBuffer is None:
+            raise ValueError('No chunk is being buffered')
+        chunk = self.chunkBuffer
+        pid = self.chunkPid
+        self.chunkBuffer = None
+        self.chunkPid = None
+        attrs = {fieldName:self.attrDict.pop(fieldName) for fieldName in chunk if fieldName in self.attrDict}
+        options = {fieldName:self.creationOptions.pop(fieldName) for fieldName in chunk if fieldName in self.creationOptions}
+        manifest = self.manifest()
+        if self.writeQueue > 0:
+            self.queue_chunk(pid, chunk, attrs, options, manifest)
+            return
+        t0 = time.time()
+        self.write_pid(pid, chunk, attrs, options, manifest)
+        self.add_write_stats(1, time.time() - t0, time.time() - t0)
+
+    #writes the fields of a pid to its partial group and moves the group to
+    #the name of the pid, which hdf5 does as a single change of links. The
+    #file is flushed before the pid is added to the manifest, so the
+    #manifest only holds pids that are complete on disk
+    def write_pid(self, pid, chunk, attrs, options, manifest):
+        pidName = str(pid).zfill(6)
+        partialName = pidName + _partialSuffix
+        if partialName in self.outFile:
+            del self.outFile[partialName]
+        names = {}
+        for fieldName in chunk.keys():
+            name = fieldName.lstrip('/')
+            names[fieldName] = partialName + name[len(pidName):] if name.split('/')[0] == pidName else fieldName
+        self.write_fields({names[k]:v for k, v in chunk.items()}, {names[k]:v for k, v in attrs.items()}, {names[k]:v for k, v in options.items()})
+        if partialName in self.outFile:
+            if pidName in self.outFile:
+                self.merge_group(partialName, pidName)
+            else:
+                self.outFile.move(partialName, pidName)
+        self.outFile.flush()
+        self.write_manifest(manifest)
+
+    #moves the members of the group source into the group target, which
+    #holds fields of the pid written outside of its chunk. Unlike moving a
+    #whole group this is not a single change
+    def merge_group(self, source, target):
+        for name in list(self.outFile[source].keys()):
+            sourceName, targetName = source + '/' + name, target + '/' + name
+            if targetName in self.outFile and isinstance(self.outFile[sourceName], h5py.Group) and isinstance(self.outFile[targetName], h5py.Group):
+                self.merge_group(sourceName, targetName)
+                continue
+            if targetName in self.outFile:
+                if not self.overwrite:
+                    raise OSError(targetName + ' is already in ' + self.outName)
+                del self.outFile[targetName]
+            self.outFile.move(sourceName, targetName)
+        del self.outFile[source]
+
+    #creates the datasets and links of a chunk together with their
+    #attributes, using the preset creation properties
+    def write_fields(self, chunk, attrs, options):
+        for fieldName, data in chunk.items():
+            if isinstance(data, h5py.SoftLink):
+                self.outFile[fieldName] = data
+                continue
+            data = np.asarray(data)
+            if data.dtype.kind in 'OU' or fieldName in options:
+                #left to h5py to convert to a string type or to set up the
+                #chunks and filters of an hdf5 step
+                self.write_field(fieldName, data, options.get(fieldName), attrs.get(fieldName, {}))
+                continue
+            if not data.flags.c_contiguous:
+                data = data.copy()
+            try:
+                dset = self.create_dataset(fieldName, data)
+            except (OSError, ValueError) as e:
+                if not self.overwrite or fieldName not in self.outFile:
+                    raise OSError(e)
+                del self.outFile[fieldName]
+                dset = self.create_dataset(fieldName, data)
+            if fieldName in attrs:
+                dsetAttrs = h5py.Dataset(dset).attrs
+                for attrName, value in attrs[fieldName].items():
+                    dsetAttrs[attrName] = value
+
+    #hands the fields of a pid to the writer thread, starting it for the
+    #first pid of the file. put blocks while writeQueue pids are waiting,
+    #which holds back the encoding until the writes catch up
+    def queue_chunk(self, pid, chunk, attrs, options, manifest):
+        if self.writeError is not None:
+            self.flush_writes()
+        if self.writer is None:
+            self.writeItems = queue.Queue(maxsize=self.writeQueue)
+            self.writer = threading.Thread(target=self.write_loop, args=(self.writeItems,), daemon=True)
+            self.writer.start()
+        t0 = time.time()
+        self.writeItems.put((pid, chunk, attrs, options, manifest))
+        self.add_write_stats(blocked=time.time() - t0)
+
+    #runs on the writer thread until it gets None. After an error the
+    #remaining pids are dropped, so put never blocks, until flush_writes
+    #raises it
+    def write_loop(self, items):
+        while True:
+            item = items.get()
+            if item is None:
+                return
+            pid, chunk, attrs, options, manifest = item
+            if self.writeError is not None:
+                continue
+            t0 = time.time()
+            try:
+                self.write_pid(pid, chunk, attrs, options, manifest)
+            except Exception as e:
+                self.writeError = (pid, e)
+            self.add_write_stats(1, time.time() - t0)
+
+    #waits for the writer thread to write every queued pid and stops it,
+    #raising the first error it ran into
+    def flush_writes(self):
+        if self.writer is not None:
+            t0 = time.time()
+            self.writeItems.put(None)
+            self.writer.join()
+            self.add_write_stats(blocked=time.time() - t0)
+            self.writer = None
+            self.writeItems = None
+        if self.writeError is not None:
+            pid, e = self.writeError
+            self.writeError = None
+            raise OSError('Error writing pid ' + str(pid) + ' to ' + self.outName + ': ' + str(e)) from e
+
+    def add_write_stats(self, pids=0, write=0.0, blocked=0.0):
+        with self.writeStatsLock:
+            self.writeStats['pids'] += pids
+            self.writeStats['write'] += write
+            self.writeStats['blocked'] += blocked
+
+    #the writeStats together with the fraction of the writing that was
+    #hidden behind the encoding, which is 0 without a writeQueue
+    def write_stats(self):
+        with self.writeStatsLock:
+            stats = dict(self.writeStats)
+        stats['overlap'] = max(0.0, 1 - stats['blocked']/stats['write']) if stats['write'] > 0 else 0.0
+        return stats
+
+    #creates and fills the dataset of a field from a contiguous array with
+    #the low level api, creating the groups above it
+    def create_dataset(self, fieldName, data):
+        tid = h5py.h5t.py_create(data.dtype, logical=True)
+        if data.ndim == 0:
+            space = h5py.h5s.create(h5py.h5s.SCALAR)
+        else:
+            space = h5py.h5s.create_simple(data.shape)
+        dcpl = _compactDcpl if data.nbytes <= _compactBytes and not self.memmap else _contiguousDcpl
+        dset = h5py.h5d.create(self.outFile.id, fieldName.encode(), tid, space, dcpl=dcpl, lcpl=_groupLcpl)
+        if data.size > 0:
+            dset.write(h5py.h5s.ALL, h5py.h5s.ALL, data)
+        return dset
  
     def add_encoding(self, encoding, value):
         if encoding not in self.encodings.keys():
@@ -145,6 +705,7 @@ class commander_tod:
                print('Warning: Inconsistant encoding value ' + encoding + ' is set to ' + str(self.encodings[encoding]) + ' but wants to be ' + str(value))
 
     def finalize_file(self):
+        self.flush_writes()
 
         if(not self.exists):
             for encoding in self.encodings.keys():
@@ -153,75 +714,677 @@ class commander_tod:
 
             self.add_field('/common/version', self.version)
             self.add_field('/common/pids', list(self.pids.keys()))
+            if self.digest is not None:
+                self.add_field('/common/digest', np.bytes_(self.digest))
+                self.add_field('/common/provenance', np.bytes_(self.provenance_json(self.provenance)))
 
         if self.filelists is not None:
             for pid in self.pids.keys():
-                self.filelists[self.freq]['id' + str(pid)] = str(pid) + ' "' + os.path.abspath(self.outName) + '" ' + '1 ' + self.pids[pid] + '\n'       
+                self.filelists[self.freq]['id' + str(pid)] = [int(pid), os.path.abspath(self.outName), self.pids[pid]]
+
+        if self.catalogs is not None:
+            self.catalogs[self.freq][os.path.basename(self.outName)] = self.catalog_rows()
+
+        #the file is complete once its common fields are on disk
+        if os.path.exists(self.manifest_name()):
+            self.outFile.flush()
+            os.remove(self.manifest_name())
  
         return
 
-    def finalize_chunk(self, pid, loadBalance=[0,0]):
+    #finalizes the fields of pid, storing the digest of its provenance (see
+    #pid_current) if given
+    def finalize_chunk(self, pid, loadBalance=[0,0], provenance=None):
         if len(loadBalance) != 2:
             raise ValueError('Load Balancing numbers must be length 2')
+        #the codecs share no state, so the trees of every dictionary and
+        #then the fields using them are encoded concurrently. Chunked fields
+        #are encoded on this thread as they are written
+        pool = ThreadPoolExecutor(max_workers=self.threads)
+        trees = {}
+        for key in self.huffDict.keys():
+            trees[key] = pool.submit(self.select_tree, key, list(self.huffDict[key].values()))
+        codes = {}
+        for key in self.huffDict.keys():
+            h, shared = trees[key].result()
+            for field, delta in self.huffDict[key].items():
+                if type(delta) is not tuple:
+                    codes[field] = pool.submit(self.encode_field, h, delta)
+
         for key in self.huffDict.keys():
-            h = huffman.Huffman()
-            h.GenerateCode(list(self.huffDict[key].values()))
-            huffArray = np.append(np.append(np.array(h.node_max), h.left_nodes), h.right_nodes)
+            h, shared = trees[key].result()
             numStr = str(key)
             if(key == 1):
                 numStr = ''
 
-            self.add_field('/' + str(pid).zfill(6) + '/common/hufftree' + numStr, huffArray)
-            self.add_field('/' + str(pid).zfill(6) + '/common/huffsymb' + numStr, h.symbols)
-            #with np.printoptions(threshold=np.inf):
-            #    print(huffArray, len(huffArray), len(h.symbols))
-            for field in self.huffDict[key].keys():
-                self.add_field(field, np.void(bytes(h.byteCode(self.huffDict[key][field]))))
-                #print(self.huffDict[key][field], bin(int.from_bytes(h.byteCode(self.huffDict[key][field]), byteorder=sys.byteorder)))
+            if shared:
+                self.link_shared_tree(pid, h, numStr)
+            elif h.lengths is not None:
+                self.add_field('/' + str(pid).zfill(6) + '/common/hufflen' + numStr, np.uint8(h.lengths))
+                self.add_field('/' + str(pid).zfill(6) + '/common/huffsymb' + numStr, h.symbols)
+            else:
+                huffArray = np.append(np.append(np.array(h.node_max), h.left_nodes), h.right_nodes)
+                self.add_field('/' + str(pid).zfill(6) + '/common/hufftree' + numStr, huffArray)
+                self.add_field('/' + str(pid).zfill(6) + '/common/huffsymb' + numStr, h.symbols)
+            for field, delta in self.huffDict[key].items():
+                escapes = []
+                if type(delta) is tuple:
+                    self.add_field(field, np.void(self.stream_field(h, field, delta, escapes)))
+                else:
+                    code, delta, index, diff = codes[field].result()
+                    self.add_field(field, np.void(code))
+                    escapes.append((index, diff))
+                self.add_escapes(field, escapes)
+                if field in self.syncSteps:
+                    if type(delta) is tuple:
+                        delta = self.escape_chunks(h, self.chunk_deltas(field, delta[0], delta[1]), [])
+                    else:
+                        delta = [delta]
+                    syncBits, syncValues, n = h.SyncPoints(delta, self.syncSteps[field])
+                    self.add_field(field + sideSuffixes['sync'], side_table(bits=syncBits, values=syncValues))
+                    self.add_attribute(field, 'huffmanSyncLength', n)
+        pool.shutdown()
 
         self.huffDict = {}
+        self.huffModes = {}
+        self.syncSteps = {}
+        if len(self.fieldStats) > 0:
+            self.add_field('/' + str(pid).zfill(6) + '/common/stats', self.stats_table(pid))
+        if provenance is not None:
+            self.add_field('/' + str(pid).zfill(6) + '/common/digest', np.bytes_(self.compute_version(provenance)))
         self.add_field('/' + str(pid).zfill(6) + '/common/load', loadBalance)
         self.pids[pid] = str(float(loadBalance[0])) + ' ' + str(float(loadBalance[1]))
+        if self.chunkBuffer is not None:
+            if self.chunkPid != pid:
+                raise ValueError('Finalizing pid ' + str(pid) + ' while buffering pid ' + str(self.chunkPid))
+            self.write_chunk()
 
-    def compute_version(self):
-        return
+    #the statistics gathered since the last pid as a table (see
+    #summary.stats_table), named relative to the group of pid where they are
+    #in it, and starts gathering them afresh
+    def stats_table(self, pid):
+        prefix = str(pid).zfill(6) + '/'
+        fieldStats = {}
+        for fieldName, fieldSummary in self.fieldStats.items():
+            name = fieldName.lstrip('/')
+            fieldStats[name[len(prefix):] if name.startswith(prefix) else fieldName] = fieldSummary
+        self.fieldStats = {}
+        return summary.stats_table(fieldStats)
+
+    #builds the tree of one dictionary from the differenced fields and the
+    #symbol counts of the chunked fields, a canonical one for the mode of a
+    #canonical step
+    @staticmethod
+    def build_tree(deltas, mode=('huffman', None)):
+        hist = huffman.Histogram()
+        for delta in deltas:
+            if type(delta) is tuple:
+                hist.Merge(delta[2])
+            else:
+                hist.Add(delta)
+        h = huffman.Huffman()
+        if mode[0] == 'canonical':
+            h.CanonicalFromWeights(hist.symbols, hist.counts, mode[1])
+        else:
+            h.TreeFromWeights(hist.symbols, hist.counts)
+        return h
+
+    def stream_field(self, h, fieldName, stream, escapes):
+        chunks, compression, hist = stream
+        b = io.BytesIO()
+        h.StreamCode(self.escape_chunks(h, self.chunk_deltas(fieldName, chunks, compression), escapes), b)
+        return b.getvalue()
+
+    #sets the mission wide dictionary dictNum of frequency freq to a tree
+    #trained on the symbol counts in hist, which is used for every pid where
+    #at most a maxEscape fraction of the samples are missing from it
+    def set_dictionary(self, freq, dictNum, hist, maxEscape=0):
+        h = huffman.Huffman()
+        h.EscapeTreeFromWeights(hist.symbols, hist.counts)
+        self.sharedDicts[(freq, dictNum)] = (h, maxEscape)
+
+    #the symbol counts the shared dictionaries of freq were trained on are
+    #kept in outPath, so a later run resuming or updating the files of freq
+    #builds the very same trees instead of training new ones
+    def dictionary_name(self, freq):
+        return os.path.join(self.outPath, 'dictionaries_0' + str(freq) + '.npz')
+
+    #writes the histograms of freq, keyed by dictNum, to its dictionary file
+    def save_dictionaries(self, freq, hists):
+        dictName = self.dictionary_name(freq)
+        arrays = {}
+        for dictNum, hist in hists.items():
+            arrays['symbols' + str(dictNum)] = hist.symbols
+            arrays['counts' + str(dictNum)] = hist.counts
+        #written under a temporary name so a reader never sees it partly
+        tmpName = dictName + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpName, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmpName, dictName)
+
+    #sets the shared dictionaries of freq from its dictionary file, returning
+    #whether there was one
+    def load_dictionaries(self, freq, maxEscape=0):
+        if not os.path.exists(self.dictionary_name(freq)):
+            return False
+        with np.load(self.dictionary_name(freq)) as arrays:
+            for name in arrays.files:
+                if name.startswith('symbols'):
+                    dictNum = int(name[len('symbols'):])
+                    hist = huffman.Histogram()
+                    hist.AddWeights(arrays[name], arrays['counts' + str(dictNum)])
+                    self.set_dictionary(freq, dictNum, hist, maxEscape)
+        return True
+
+    #returns the codec for the fields of dictionary key and whether it is the
+    #shared one, falling back to a tree built for this pid alone when no
+    #dictionary has been trained or too many samples would need escaping.
+    #Samples escaped from a shared tree are stored beside the stream and are
+    #only understood by this reader, so the default maxEscape of 0 keeps the
+    #files readable by commander itself
+    def select_tree(self, key, deltas):
+        mode = self.huffModes.get(key, ('huffman', None))
+        if (self.freq, key) in self.sharedDicts and mode[0] == 'huffman':
+            h, maxEscape = self.sharedDicts[(self.freq, key)]
+            missing, total = 0, 0
+            for delta in deltas:
+                if type(delta) is tuple:
+                    hist = delta[2]
+                    missing += np.sum(hist.counts[~h.Contains(hist.symbols)])
+                    total += np.sum(hist.counts)
+                else:
+                    missing += np.count_nonzero(~h.Contains(delta))
+                    total += len(delta)
+            if missing <= maxEscape*total:
+                return h, True
+        return self.build_tree(deltas, mode), False
 
-    def make_filelists(self):
-        for freq in self.filelists.keys():
+    #returns the code of delta together with the escaped delta it encodes and
+    #the positions and differences of the escaped samples
+    @staticmethod
+    def encode_field(h, delta):
+        delta, index, diff = h.Escape(delta)
+        return bytes(h.byteCode(delta)), delta, index, diff
+
+    #escapes the pieces of a chunked field, collecting the positions and
+    #differences of the escaped samples in escapes
+    @staticmethod
+    def escape_chunks(h, deltas, escapes):
+        n = 0
+        for delta in deltas:
+            delta, index, diff = h.Escape(delta, n)
+            escapes.append((index, diff))
+            n += len(delta)
+            yield delta
+
+    #stores the escaped samples of a field in its side dataset
+    def add_escapes(self, fieldName, escapes):
+        index = np.concatenate([e[0] for e in escapes]) if len(escapes) > 0 else []
+        if len(index) > 0:
+            self.add_field(fieldName + sideSuffixes['escape'], side_table(index=index, delta=np.concatenate([e[1] for e in escapes])))
+
+    #stores a shared tree once in /common and links the tree of the pid to
+    #it, so commander reads it as if it belonged to the pid
+    def link_shared_tree(self, pid, h, numStr):
+        huffArray = np.append(np.append(np.array(h.node_max), h.left_nodes), h.right_nodes)
+        treeName = '/common/hufftree' + numStr
+        if treeName in self.outFile:
+            if not np.array_equal(self.outFile[treeName][()], huffArray):
+                raise ValueError(self.outName + ' already holds a different shared dictionary ' + treeName)
+        else:
+            #written straight away rather than with the chunk of the pid, so
+            #the next pid finds it even while this one waits for the writer
+            self.write_field(treeName, huffArray)
+            self.write_field('/common/huffsymb' + numStr, h.symbols)
+        for name in ['hufftree', 'huffsymb']:
+            linkName = '/' + str(pid).zfill(6) + '/common/' + name + numStr
+            if self.chunkBuffer is not None:
+                #created in the partial group of the pid by write_pid
+                self.chunkBuffer[linkName] = h5py.SoftLink('/common/' + name + numStr)
+                continue
+            if linkName in self.outFile and self.overwrite:
+                del self.outFile[linkName]
+            self.outFile[linkName] = h5py.SoftLink('/common/' + name + numStr)
+
+    #returns the sha1 of a provenance, a dict of everything a file or a pid
+    #is made from: the inputs (see file_provenance), the compression chains
+    #and other parameters, the auxiliary numbers used and the code (see
+    #source_digest). Equal digests mean the output would come out the same
+    def compute_version(self, provenance):
+        return hashlib.sha1(self.provenance_json(provenance).encode()).hexdigest()
+
+    #a provenance as json, with sorted keys and exact floats so it is
+    #canonical. numpy arrays and scalars are written as lists and numbers
+    @staticmethod
+    def provenance_json(provenance):
+        def default(value):
+            if isinstance(value, (np.ndarray, np.generic)):
+                return value.tolist()
+            if isinstance(value, bytes):
+                return value.decode()
+            raise TypeError(type(value).__name__ + ' cannot be part of a provenance')
+        return json.dumps(provenance, sort_keys=True, default=default)
+
+    #sets what the file being written is made from, right after init_file,
+    #which finalize_file stores in /common/provenance together with its
+    #digest. A file found with another digest, or none, is out of date and
+    #is started over. Returns whether the pids found in the file were kept
+    def set_provenance(self, provenance):
+        self.provenance = provenance
+        self.digest = self.compute_version(provenance)
+        if not self.exists and len(self.pids) == 0:
+            return False
+        if self.storedDigest == self.digest:
+            return True
+        self.reset_file()
+        return False
+
+    #the digest stored with pid by finalize_chunk, or None
+    def pid_digest(self, pid):
+        name = '/' + str(pid).zfill(6) + '/common/digest'
+        if name not in self.outFile:
+            return None
+        return self.outFile[name][()].decode()
+
+    #whether pid is in the file and was made from provenance, so it need not
+    #be converted again
+    def pid_current(self, pid, provenance):
+        return pid in self.pids and self.pid_digest(pid) == self.compute_version(provenance)
+
+    #removes a pid that is out of date from the file and the manifest, so it
+    #can be written again
+    def remove_pid(self, pid):
+        self.flush_writes()
+        pidName = str(pid).zfill(6)
+        if pidName in self.outFile:
+            del self.outFile[pidName]
+        self.pids.pop(pid, None)
+        self.outFile.flush()
+        self.write_manifest(self.manifest())
+
+    #writes the filelists of the pids collected by finalize_file or, without
+    #any, of every pid in the catalogs of freqs, in order of pid. The weight
+    #of a pid, by which commander balances its processes, is its cost (see
+    #balance.scan_costs) over the mean cost where the catalog has it, and 1
+    #otherwise. With ranks the assignment of the pids to every number of
+    #processes in ranks is written too, see write_assignment
+    def make_filelists(self, freqs=None, ranks=[]):
+        filelists = self.filelists
+        if filelists is None:
+            filelists = {}
+            for freq in freqs:
+                catalog = self.load_catalog(freq)
+                filelists[freq] = {}
+                for pid, fileName, load0, load1 in zip(catalog['pid'], catalog['fileName'], catalog['load0'], catalog['load1']):
+                    filelists[freq]['id' + str(pid)] = [int(pid), os.path.abspath(os.path.join(self.outPath, fileName)), str(float(load0)) + ' ' + str(float(load1))]
+        for freq in filelists.keys():
+            entries = sorted(filelists[freq].values())
+            pids = np.array([entry[0] for entry in entries], dtype=np.int64)
+            weights = self.scan_weights(freq, pids)
             outfile = open(os.path.join(self.outPath, 'filelist_' + str(freq) + '.txt'), 'w')
-            outfile.write(str(len(self.filelists[freq])) + '\n')
-            for buf in self.filelists[freq].values():
-                #print(buf, len(buf))
-                outfile.write(buf)
+            outfile.write(str(len(entries)) + '\n')
+            for (pid, fileName, loadBalance), weight in zip(entries, weights):
+                outfile.write(str(pid) + ' "' + fileName + '" ' + '{:.6g}'.format(weight) + ' ' + loadBalance + '\n')
 
             outfile.close()
 
+            for nranks in ranks:
+                self.write_assignment(freq, pids, weights, nranks)
+
         return
 
+    #weights of pids in the filelist of freq, the costs of the pids in the
+    #catalog over their mean. Pids missing from it get the mean
+    def scan_weights(self, freq, pids):
+        weights = np.ones(len(pids))
+        if not os.path.exists(self.catalog_name(freq)) or len(pids) == 0:
+            return weights
+        catalog = self.load_catalog(freq)
+        costs = balance.scan_costs(catalog)
+        index = np.minimum(np.searchsorted(catalog['pid'], pids), len(catalog['pid']) - 1)
+        found = catalog['pid'][index] == pids if len(catalog['pid']) > 0 else np.zeros(len(pids), dtype=bool)
+        if np.any(found) and np.mean(costs[index[found]]) > 0:
+            weights[found] = costs[index[found]]/np.mean(costs[index[found]])
+        return weights
+
+    #writes the assignment of the pids of a filelist to ranks processes that
+    #balances their weights, largest first (see balance.lpt_assignment), as
+    #the number of pids followed by a line of pid and process per pid
+    def write_assignment(self, freq, pids, weights, ranks):
+        assignment = balance.lpt_assignment(weights, ranks)
+        with open(self.assignment_name(freq, ranks), 'w') as f:
+            f.write(str(len(pids)) + '\n')
+            for pid, rank in zip(pids, assignment):
+                f.write(str(pid) + ' ' + str(rank) + '\n')
+
+    def assignment_name(self, freq, ranks):
+        return os.path.join(self.outPath, 'assignment_0' + str(freq) + '_' + str(ranks) + '.txt')
+
+    #Scan catalogs
+    #every frequency has a catalog in outPath with a row per pid, kept as
+    #columns (catalogColumns) in an npz file, so the pids can be found and
+    #summarized without opening the files holding them
+
+    def catalog_name(self, freq):
+        return os.path.join(self.outPath, 'catalog_0' + str(freq) + '.npz')
+
+    #returns the catalog rows of the pids of the open file
+    def catalog_rows(self):
+        fsamp = self.outFile['/common/fsamp'][()].ravel()[0] if '/common/fsamp' in self.outFile else np.nan
+        pids = self.pids.keys() if len(self.pids) > 0 else self.outFile['/common/pids'][()]
+        rows = []
+        for pid in sorted(int(pid) for pid in pids):
+            group = self.outFile[str(pid).zfill(6)]
+            common = group['common']
+            ntod = int(common['ntod'][()].ravel()[0]) if 'ntod' in common else 0
+            load = common['load'][()].ravel() if 'load' in common else [0, 0]
+            mjd = float(common['time'][()].ravel()[0]) if 'time' in common else np.nan
+            dets = [det for det in group.keys() if det != 'common']
+            fields = set()
+            compressions = set()
+            nbytes = [0]
+            def visit(name, obj):
+                if isinstance(obj, h5py.Dataset):
+                    nbytes[0] += obj.id.get_storage_size()
+                    if 'compression' in obj.attrs:
+                        compressions.add(str(obj.attrs['compression']).strip())
+                    if not name.startswith('common/') and not is_side_dataset(name):
+                        fields.add(name.split('/')[-1])
+            group.visititems(visit)
+            rows.append({'pid':pid, 'od':int(self.od), 'fileName':os.path.basename(self.outName), 'ntod':ntod, 'load0':float(load[0]), 'load1':float(load[1]), 'mjdStart':mjd, 'mjdEnd':mjd + ntod/fsamp/86400., 'nbytes':nbytes[0], 'dets':','.join(dets), 'fields':','.join(sorted(fields)), 'compression':','.join(sorted(compressions))})
+        return rows
+
+    #merges the rows collected by finalize_file into the catalogs, replacing
+    #the rows of the files they come from
+    def make_catalogs(self):
+        for freq in self.catalogs.keys():
+            rows = []
+            for fileRows in self.catalogs[freq].values():
+                rows += fileRows
+            self.write_catalog(freq, rows)
+
+    #writes the catalog of freq from rows, keeping the rows of other files
+    #that are already in it unless replace is set
+    def write_catalog(self, freq, rows, replace=False):
+        columns = {name:np.array([row[name] for row in rows], dtype=dtype) for name, dtype in catalogColumns}
+        catalogName = self.catalog_name(freq)
+        if os.path.exists(catalogName) and not replace:
+            old = self.load_catalog(freq)
+            keep = ~np.isin(old['fileName'], columns['fileName'])
+            columns = {name:np.concatenate([old[name][keep], columns[name]]).astype(dtype) for name, dtype in catalogColumns}
+        order = np.argsort(columns['pid'], kind='stable')
+        #written under a temporary name so a reader never sees it partly
+        tmpName = catalogName + '.' + str(os.getpid()) + '.tmp'
+        with open(tmpName, 'wb') as f:
+            np.savez(f, **{name:column[order] for name, column in columns.items()})
+        os.replace(tmpName, catalogName)
+
+    #returns the catalog of freq as a dict of columns sorted by pid
+    def load_catalog(self, freq):
+        with np.load(self.catalog_name(freq)) as catalog:
+            return {name:catalog[name] for name, dtype in catalogColumns}
+
+    #returns the catalog row of pid at freq (that of the open file by
+    #default) as a dict, raising KeyError for pids not in the catalog
+    def locate_pid(self, pid, freq=None):
+        catalog = self.load_catalog(self.across_freq(freq))
+        i = np.searchsorted(catalog['pid'], pid)
+        if i == len(catalog['pid']) or catalog['pid'][i] != pid:
+            raise KeyError('pid ' + str(pid) + ' is not in the catalog')
+        return {name:column[i].item() for name, column in catalog.items()}
+
     #File Reading Functions
-    def load_field(self, fieldName):
+    #start and stop select samples start...stop-1 of the field, decoding
+    #only the part between the nearest sync points of huffman fields that
+    #have them. pool is a multiprocessing pool that decodes such fields in
+    #parallel pieces. The samples are written to out if it is given, which
+    #must have their number of elements
+    def load_field(self, fieldName, start=None, stop=None, pool=None, out=None):
+        if out is None and fieldName in self.fieldMaps:
+            return self.fieldMaps[fieldName][start:stop]
         try:
             compStr = self.outFile[fieldName].attrs['compression']
         except KeyError:
-            return self.outFile[fieldName]
+            compStr = None
+        if self.memmap and out is None and (compStr is None or all(comp in ['', 'dtype'] for comp in compStr.split(' '))):
+            data = self.map_field(fieldName, start, stop)
+            if data is not None:
+                return data
 
-        return self.decompress(fieldName, compression=compStr)       
+        if compStr is None:
+            if out is not None:
+                self.outFile[fieldName].read_direct(out, np.s_[start:stop])
+                return out
+            if start is None and stop is None:
+                return self.outFile[fieldName]
+            return self.outFile[fieldName][start:stop]
 
-    def load_all_fields(self):
-        return
+        return self.decompress(fieldName, compression=compStr, start=start, stop=stop, pool=pool, out=out)
 
-    def read_across_files(self, fieldName):
-        return
+    #returns a read only memory map of samples start...stop-1 of a field
+    #stored uncompressed in one contiguous block of a file opened for
+    #reading, or None for fields stored any other way. The map of the whole
+    #field is kept in fieldMaps for later reads of the file
+    def map_field(self, fieldName, start=None, stop=None):
+        dset = self.outFile[fieldName]
+        if self.outFile.mode != 'r' or self.outFile.driver != 'sec2' or dset.chunks is not None or dset.ndim == 0 or dset.size == 0 or dset.dtype.hasobject:
+            return None
+        offset = dset.id.get_offset()
+        if offset is None:
+            return None
+        data = np.memmap(self.outFile.filename, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+        self.fieldMaps[fieldName] = data
+        if start is None and stop is None:
+            return data
+        return data[start:stop]
+
+    #returns the fields of a pid as a dict of field_groups, one per detector
+    #in dets (all of them by default) with the fields in fields (all of them
+    #by default), and one under 'common' with the fields shared by the
+    #detectors. Fields are read and decompressed on first access. With a
+    #pool the detector fields are all decoded up front, concurrently: a
+    #concurrent.futures executor of threads decodes them from this file,
+    #while the workers of a multiprocessing pool open the file themselves
+    def load_all_fields(self, pid, dets=None, fields=None, pool=None):
+        pidName = '/' + str(pid).zfill(6)
+        pidGroup = self.outFile[pidName]
+        if dets is None:
+            dets = [det for det in pidGroup.keys() if det != 'common']
+        data = {'common':field_group(self, pidName + '/common', dataset_names(pidGroup['common']))}
+        for det in dets:
+            names = dataset_names(pidGroup[det]) if fields is None else fields
+            data[det] = field_group(self, pidName + '/' + det, names)
+
+        if pool is not None:
+            jobs = {}
+            for det in dets:
+                for name in data[det].keys():
+                    fieldName = data[det].group + '/' + name
+                    if hasattr(pool, 'apply_async'):
+                        jobs[(det, name)] = pool.apply_async(load_file_field, args=[self.outPath, self.freq, self.od, fieldName])
+                    else:
+                        jobs[(det, name)] = pool.submit(self.read_field, fieldName)
+            for (det, name), job in jobs.items():
+                data[det].cache[name] = job.get() if hasattr(job, 'get') else job.result()
+        return data
+
+    #returns the samples of a field as an array, rather than the dataset
+    #load_field gives for uncompressed ones
+    def read_field(self, fieldName):
+        data = self.load_field(fieldName)
+        if isinstance(data, h5py.Dataset):
+            data = data[()]
+        return data
+
+    #returns the table of statistics finalize_chunk stored for pid, or None
+    #if none were gathered. Its field column holds the field names under the
+    #group of the pid, such as b'27M/tod'
+    def load_stats(self, pid):
+        name = '/' + str(pid).zfill(6) + '/common/stats'
+        if name not in self.outFile:
+            return None
+        return self.outFile[name][()]
+
+    #yields the od, the pids and the fieldName field of every detector in
+    #dets for every pid of the files of ods at freq (that of the open file
+    #by default), in the order of ods and pids, skipping missing files.
+    #Fields missing from a pid are None. The files are read by the workers
+    #of pool if given, a multiprocessing pool or concurrent.futures
+    #executor, and are still yielded in order
+    def iter_across_files(self, fieldName, dets, ods, freq=None, pool=None):
+        freq = self.across_freq(freq)
+        args = [(self.outPath, freq, od, fieldName, list(dets)) for od in ods]
+        if pool is None:
+            results = map(read_file_fields, args)
+        elif hasattr(pool, 'imap'):
+            results = pool.imap(read_file_fields, args)
+        else:
+            results = pool.map(read_file_fields, args)
+        for od, res in zip(ods, results):
+            if res is not None:
+                yield (od,) + res
+
+    #returns the fieldName field of every detector in dets across the files
+    #of ods as (pids, series, offsets): the pids in order, and by detector
+    #the fields of all pids concatenated along their first axis and the
+    #offsets of the rows of every pid, so pid pids[i] holds
+    #series[det][offsets[det][i]:offsets[det][i+1]]. With a cacheDir the
+    #result is kept there as npz, keyed by the request and the modification
+    #times of the files, and returned from it while they do not change
+    def read_across_files(self, fieldName, dets, ods, freq=None, pool=None, cacheDir=None):
+        freq = self.across_freq(freq)
+        dets = list(dets)
+        ods = list(ods)
+        if cacheDir is not None:
+            cacheName = self.across_cache_name(fieldName, dets, ods, freq, cacheDir)
+            if os.path.exists(cacheName):
+                with np.load(cacheName) as cache:
+                    return cache['pids'], {det:cache['series_' + det] for det in dets}, {det:cache['offsets_' + det] for det in dets}
+
+        pids = []
+        pieces = {det:[] for det in dets}
+        for od, odPids, data in self.iter_across_files(fieldName, dets, ods, freq, pool):
+            pids += odPids
+            for det in dets:
+                pieces[det] += data[det]
+
+        pids = np.array(pids, dtype=np.int64)
+        series, offsets = {}, {}
+        for det in dets:
+            arrays = [np.atleast_1d(x) for x in pieces[det] if x is not None]
+            offsets[det] = np.append(0, np.cumsum([0 if x is None else len(np.atleast_1d(x)) for x in pieces[det]])).astype(np.int64)
+            series[det] = np.concatenate(arrays) if len(arrays) > 0 else np.zeros(0)
+
+        if cacheDir is not None:
+            os.makedirs(cacheDir, exist_ok=True)
+            arrays = {'pids':pids}
+            for det in dets:
+                arrays['series_' + det] = series[det]
+                arrays['offsets_' + det] = offsets[det]
+            #written under a temporary name so a reader never sees it partly
+            tmpName = cacheName + '.' + str(os.getpid()) + '.tmp'
+            with open(tmpName, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmpName, cacheName)
+        return pids, series, offsets
+
+    def across_freq(self, freq):
+        if freq is None:
+            freq = getattr(self, 'freq', None)
+        if freq is None:
+            raise ValueError('No frequency given and no file initialized')
+        return freq
+
+    def across_cache_name(self, fieldName, dets, ods, freq, cacheDir):
+        files = []
+        for od in ods:
+            try:
+                st = os.stat(self.file_name(freq, od))
+                files.append((od, st.st_mtime_ns, st.st_size))
+            except OSError:
+                files.append((od, None, None))
+        key = hashlib.sha1(repr((os.path.abspath(self.outPath), freq, fieldName, dets, files)).encode()).hexdigest()
+        return os.path.join(cacheDir, 'across_0' + str(freq) + '_' + fieldName.replace('/', '_') + '_' + key[:16] + '.npz')
+
+    #returns the huffman codec of a pid, reading and building it only if it
+    #is not among the treeCacheSize most recently used ones
+    def load_tree(self, pid, huffNum, canonical=False):
+        group = '/' + pid + '/common'
+        link = self.outFile.get(group + '/hufftree' + huffNum, getlink=True)
+        if isinstance(link, h5py.SoftLink):
+            #pids using a shared dictionary share its cache entry
+            group = '/common'
+            pid = 'common'
+        key = (self.outName, pid, huffNum)
+        with self.treeCacheLock:
+            if key in self.treeCache:
+                self.treeCache.move_to_end(key)
+                self.treeCacheHits += 1
+                return self.treeCache[key]
+            self.treeCacheMisses += 1
+
+        huffSymb = self.load_field(group + '/huffsymb' + huffNum)
+        if canonical:
+            h = huffman.Huffman(symb=huffSymb, lengths=self.load_field(group + '/hufflen' + huffNum))
+        else:
+            h = huffman.Huffman(tree=self.load_field(group + '/hufftree' + huffNum), symb=huffSymb)
+
+        with self.treeCacheLock:
+            self.treeCache[key] = h
+            while len(self.treeCache) > self.treeCacheSize:
+                self.treeCache.popitem(last=False)
+        return h
+
+    def tree_cache_info(self):
+        return {'hits':self.treeCacheHits, 'misses':self.treeCacheMisses, 'size':len(self.treeCache), 'maxsize':self.treeCacheSize}
+
+    #reads the bytes of an opaque field into the reusable buffer of this
+    #thread, followed by 8 zero bytes, and returns the buffer and the number
+    #of bytes of the field
+    def read_stream(self, fieldName):
+        dset = self.outFile[fieldName]
+        nbytes = dset.dtype.itemsize
+        buf = getattr(self.readBuffers, 'buf', None)
+        if buf is None or len(buf) < nbytes + 8:
+            buf = np.zeros(max(nbytes + 8, 0 if buf is None else 2*len(buf)), dtype=np.uint8)
+            self.readBuffers.buf = buf
+        dset.read_direct(buf[:nbytes].view(dset.dtype).reshape(()))
+        buf[nbytes:nbytes + 8] = 0
+        return buf, nbytes
+
+    #the sync bits and values of a huffman field with a sync step, from its
+    #side dataset
+    def sync_points(self, field):
+        points = self.outFile[field + sideSuffixes['sync']][()]
+        return points['bits'], points['values']
+
+    #the positions and differences of the samples of a huffman field escaped
+    #from its shared dictionary, from its side dataset. None if no sample was
+    #escaped
+    def escape_points(self, field):
+        name = field + sideSuffixes['escape']
+        if name not in self.outFile:
+            return None
+        escapes = self.outFile[name][()]
+        return escapes['index'], escapes['delta']
 
-    def decompress(self, field, compression=''):
+    def decompress(self, field, compression='', start=None, stop=None, pool=None, out=None):
         comps = compression.split(' ')
         data = self.outFile[field]
+        #whether the requested samples have been selected from data yet
+        sliced = start is None and stop is None
+        if not any(comp in huffmanSteps + flagSteps or comp in entropyCoders.keys() for comp in comps) and not sliced:
+            data = data[start:stop]
+            sliced = True
         for comp in comps[::-1]: # apply the filters in the reverse order
             if comp == '':
                 #residual from str.split()
                 pass
             elif comp == 'dtype':
                 pass
+            elif comp == 'hdf5':
+                #the filters are undone by hdf5 when reading
+                pass
             elif comp == 'sigma':
                 sigma0 = self.outFile[field].attrs['sigma0']
                 nsigma = self.outFile[field].attrs['nsigma']
@@ -235,7 +1398,7 @@ class commander_tod:
                 bins = np.linspace(nmin, nmax, num = nbins)
                 data = bins[data]
 
-            elif comp == 'huffman':
+            elif comp in huffmanSteps:
                 pid = field.split('/')[1]
                 try:
                     huffNum = str(self.outFile[field].attrs['huffmanDictNumber'])
@@ -243,13 +1406,246 @@ class commander_tod:
                     huffNum = ""
                 if huffNum == '1':
                     huffNum = ''
-                huffTree = self.load_field('/' + pid + '/common/hufftree' + huffNum)
-                huffSymb = self.load_field('/' + pid + '/common/huffsymb' + huffNum)
-                h = huffman.Huffman(tree=huffTree, symb=huffSymb)
-                data = h.Decoder(np.array(data))
+                h = self.load_tree(pid, huffNum, comp == 'canonical')
+                attrs = self.outFile[field].attrs
+                buf, nbytes = self.read_stream(field)
+                escapes = self.escape_points(field)
+                offset = 0
+                if 'huffmanSyncStep' in attrs and pool is not None:
+                    data = h.DecodeParallel(buf, *self.sync_points(field), pool, nbytes=nbytes)
+                elif 'huffmanSyncStep' in attrs and not sliced:
+                    ntod = int(attrs['huffmanSyncLength'])
+                    start, stop, _ = slice(start, stop).indices(ntod)
+                    data = h.DecodeSlice(buf, *self.sync_points(field), attrs['huffmanSyncStep'], ntod, start, stop, nbytes=nbytes)
+                    offset = start
+                    sliced = True
+                elif sliced and escapes is None and all(c in ['', 'dtype'] + huffmanSteps for c in comps):
+                    #nothing is done to the samples after decoding
+                    data = h.Decoder(buf, out=out, nbytes=nbytes)
+                else:
+                    data = h.Decoder(buf, nbytes=nbytes)
+                if escapes is not None:
+                    data = h.Unescape(data, *escapes, offset)
+                if not sliced:
+                    data = data[start:stop]
+                    sliced = True
+
+            elif comp in entropyCoders.keys():
+                buf, nbytes = self.read_stream(field)
+                data = np.cumsum(entropyCoders[comp]().Decode(buf[:nbytes])).astype(self.outFile[field].attrs[comp + 'Dtype'])
+                if not sliced:
+                    data = data[start:stop]
+                    sliced = True
+
+            elif comp == 'rle':
+                data = flags.decode_runs(data[()], start, stop)
+                sliced = True
+
+            elif comp == 'packbits':
+                attrs = self.outFile[field].attrs
+                data = flags.unpack_bits(data, attrs['packedBits'], attrs['packedLength'], start, stop, np.dtype(attrs['packedDtype']))
+                sliced = True
                 
             else:
                 raise ValueError('Decompression type ' + comp + ' is not a recognized operation')
+
+        if out is not None and data is not out:
+            out[...] = data
+            data = out
         return data
 
 
+
+
+#fields of one group of a pid, by name, read through comm_tod when first
+#accessed and kept afterwards
+class field_group(Mapping):
+
+    def __init__(self, comm_tod, group, names):
+        self.comm_tod = comm_tod
+        self.group = group
+        self.names = list(names)
+        self.cache = {}
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        if name not in self.cache:
+            self.cache[name] = self.comm_tod.read_field(self.group + '/' + name)
+        return self.cache[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+#returns what an input file is identified by in a provenance: its name and
+#size with its modification time or, with content, the sha1 of its contents,
+#which survives copying the file but reads all of it
+def file_provenance(path, content=False):
+    info = {'name':os.path.basename(path), 'size':os.path.getsize(path)}
+    if content:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                sha.update(block)
+        info['sha1'] = sha.hexdigest()
+    else:
+        info['mtime'] = os.stat(path).st_mtime_ns
+    return info
+
+#sha1 of the source files of the conversion code, the code version of a
+#provenance
+def source_digest(paths):
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+#the source files of commander_tod and of the tod_tools modules it codes and
+#summarizes fields with, which a conversion hashes into its code digest
+def tod_sources():
+    return [os.path.abspath(__file__)] + [module.__file__ for module in [huffman, rans, flags, balance, summary]]
+
+def dataset_names(group):
+    return [name for name, obj in group.items() if isinstance(obj, h5py.Dataset) and not is_side_dataset(name)]
+
+#whether a dataset holds the sync points or escapes of a field next to it
+def is_side_dataset(name):
+    return any(name.endswith(suffix) for suffix in sideSuffixes.values())
+
+#a table of records with a column per keyword argument, all of one length
+def side_table(**columns):
+    table = np.zeros(len(next(iter(columns.values()))), dtype=[(name, np.asarray(column).dtype) for name, column in columns.items()])
+    for name, column in columns.items():
+        table[name] = column
+    return table
+
+#reads a field of the file of freq and od in outPath, in a worker process
+#of load_all_fields
+def load_file_field(outPath, freq, od, fieldName):
+    comm_tod = commander_tod(outPath)
+    comm_tod.init_file(freq, od)
+    try:
+        return comm_tod.read_field(fieldName)
+    finally:
+        comm_tod.outFile.close()
+
+#reads the fieldName field of every detector in dets for every pid of the
+#file of freq and od in outPath, in a worker process of iter_across_files.
+#Returns the pids and the fields by detector, or None without a file
+def read_file_fields(args):
+    outPath, freq, od, fieldName, dets = args
+    comm_tod = commander_tod(outPath)
+    try:
+        comm_tod.init_file(freq, od)
+    except OSError:
+        return None
+    try:
+        pids = sorted(int(pid) for pid in comm_tod.outFile['/common/pids'])
+        data = {det:[] for det in dets}
+        for pid in pids:
+            for det in dets:
+                name = '/' + str(pid).zfill(6) + '/' + det + '/' + fieldName
+                data[det].append(comm_tod.read_field(name) if name in comm_tod.outFile else None)
+        return pids, data
+    finally:
+        comm_tod.outFile.close()
+
+#returns the pids of the file of freq and od in outPath and their tables of
+#statistics (see load_stats), in a worker process checking a conversion
+#without decoding it, or None without a file or while it is being written
+def read_file_stats(args):
+    outPath, freq, od = args
+    comm_tod = commander_tod(outPath)
+    try:
+        comm_tod.init_file(freq, od)
+    except OSError:
+        return None
+    try:
+        if os.path.exists(comm_tod.manifest_name()):
+            return None
+        pids = sorted(int(pid) for pid in comm_tod.outFile['/common/pids'])
+        return pids, [comm_tod.load_stats(pid) for pid in pids]
+    finally:
+        comm_tod.outFile.close()
+
+#returns the catalog rows of the file of freq and od in outPath, in a worker
+#process rebuilding a catalog
+def scan_catalog_file(args):
+    outPath, freq, od = args
+    comm_tod = commander_tod(outPath)
+    comm_tod.init_file(freq, od)
+    try:
+        if os.path.exists(comm_tod.manifest_name()):
+            #still being written or interrupted
+            return []
+        return comm_tod.catalog_rows()
+    finally:
+        comm_tod.outFile.close()
+
+#stands in for commander_tod in a conversion script to collect the symbol
+#counts of every huffman dictionary instead of writing files. Running it over
+#a sample of ods and merging the resulting hists trains the dictionaries
+#passed to commander_tod.set_dictionary
+class huffman_trainer(commander_tod):
+
+    def __init__(self, outPath='', version=None):
+        super().__init__(outPath, version)
+        #symbol counts keyed by (freq, dictNum)
+        self.hists = {}
+
+    def init_file(self, freq, od, mode='w'):
+        self.huffDict = {}
+        self.huffModes = {}
+        self.syncSteps = {}
+        self.attrDict = {}
+        self.encodings = {}
+        self.pids = {}
+        self.od = od
+        self.freq = freq
+        self.outName = ''
+        self.exists = False
+
+    def add_field(self, fieldName, data, compression=None, stats=None):
+        if compression is None or len(compression) == 0:
+            return
+        if(len(compression) == 2 and type(compression[0]) == str):
+            compression = [compression]
+        if compression[-1][0] not in huffmanSteps:
+            return
+        if all(compArr[0] in elementwiseSteps for compArr in compression[:-1]):
+            self.count(compression[-1], [self.fused_deltas(fieldName, data, compression[:-1])])
+            return
+        for compArr in compression[:-1]:
+            data = self.compress(fieldName, data, compArr)
+        self.count(compression[-1], [np.diff(data, prepend=0)])
+
+    def add_field_chunks(self, fieldName, chunks, compression, stats=None):
+        if(len(compression) == 2 and type(compression[0]) == str):
+            compression = [compression]
+        self.count(compression[-1], self.chunk_deltas(fieldName, chunks, compression[:-1]))
+
+    def count(self, huffArr, deltas):
+        key = (self.freq, huffArr[1]['dictNum'])
+        if key not in self.hists.keys():
+            self.hists[key] = huffman.Histogram()
+        for delta in deltas:
+            self.hists[key].Add(delta)
+
+    def add_attribute(self, fieldName, attrName, data):
+        return
+
+    def begin_chunk(self, pid):
+        return
+
+    def finalize_chunk(self, pid, loadBalance=[0,0], provenance=None):
+        return
+
+    def set_provenance(self, provenance):
+        return False
+
+    def finalize_file(self):
+        return
@@ -0,0 +1,81 @@
+#================================================================================
+#
+# Copyright (C) 2020 Institute of Theoretical Astrophysics, University of Oslo.
+#
+# This file is part of Commander3.
+#
+# Commander3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Commander3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Commander3. If not, see <https://www.gnu.org/licenses/>.
+#
+#================================================================================
+
+# Codecs for flag fields, which are constant over long stretches and only
+# use a few bits of their values
+
+import numpy as np
+
+#returns the runs of equal values of data as an array of (start, length,
+#value) records
+def encode_runs(data):
+    data = np.asarray(data).ravel()
+    starts = np.append(0, np.nonzero(data[1:] != data[:-1])[0] + 1) if len(data) > 0 else np.zeros(0, dtype=np.int64)
+    runs = np.zeros(len(starts), dtype=[('start', '<i8'), ('length', '<i8'), ('value', data.dtype)])
+    runs['start'] = starts
+    runs['length'] = np.diff(np.append(starts, len(data)))
+    runs['value'] = data[starts]
+    return runs
+
+#expands samples start...stop-1 of the runs made by encode_runs, touching
+#only the runs that overlap them
+def decode_runs(runs, start=None, stop=None):
+    starts = runs['start']
+    ends = starts + runs['length']
+    n = int(ends[-1]) if len(runs) > 0 else 0
+    start, stop, step = slice(start, stop).indices(n)
+    if stop <= start:
+        return np.zeros(0, dtype=runs['value'].dtype)
+    first = np.searchsorted(starts, start, side='right') - 1
+    last = np.searchsorted(starts, stop, side='left')
+    lengths = np.minimum(ends[first:last], stop) - np.maximum(starts[first:last], start)
+    return np.repeat(runs['value'][first:last], lengths)
+
+#packs the bit planes of the non-negative integers in data into an array of
+#shape (len(bits), ceil(len(data)/8)). bits defaults to the bits that are
+#set anywhere in data
+def pack_bits(data, bits=None):
+    data = np.asarray(data).ravel()
+    if data.dtype.kind not in 'iu' or (len(data) > 0 and data.min() < 0):
+        raise ValueError('Only non-negative integers can be packed as bits')
+    if bits is None:
+        used = int(np.bitwise_or.reduce(data)) if len(data) > 0 else 0
+        bits = [bit for bit in range(used.bit_length()) if (used >> bit) & 1]
+    elif len(data) > 0 and int(np.bitwise_or.reduce(data)) & ~sum(1 << bit for bit in bits):
+        raise ValueError('Data has bits set outside of ' + str(bits))
+    planes = np.zeros((len(bits), len(data)), dtype=np.uint8)
+    for plane, bit in zip(planes, bits):
+        plane[:] = (data >> bit) & 1
+    return np.packbits(planes, axis=-1), bits
+
+#unpacks samples start...stop-1 of the n samples packed by pack_bits, as
+#integers of dtype, that of the samples packed. packed may be an h5py
+#dataset, of which only the needed bytes are read
+def unpack_bits(packed, bits, n, start=None, stop=None, dtype=np.int64):
+    start, stop, step = slice(start, stop).indices(n)
+    if stop <= start:
+        return np.zeros(0, dtype=dtype)
+    b0, b1 = start//8, -(-stop//8)
+    planes = np.unpackbits(packed[:, b0:b1], axis=-1)[:, start - 8*b0:stop - 8*b0]
+    data = np.zeros(stop - start, dtype=dtype)
+    for plane, bit in zip(planes, bits):
+        data |= plane.astype(dtype) << int(bit)
+    return data
@@ -21,40 +21,113 @@
 
 import healpy as hp
 import numpy as np
-import heapq
+import io
 import os
 
-_node_number = 0
-
-class LeafNode:
-
-    def __init__(self, symbol, weight):
-        global _node_number
-        _node_number += 1
-        self.node_number = _node_number
-        self.symbol = symbol
-        self.weight = weight
-        self.left = None
-        self.right = None
-
-    def __lt__(self, other):
-        return self.weight < other.weight
+#number of leading bits resolved by one lookup in the decoding table
+_table_bits = 16
+
+#number of bit positions the decoder resolves per vectorized pass
+_block_bits = 1 << 16
+
+#number of samples the encoder packs per vectorized pass
+_block_samples = 1 << 18
+
+#largest dense value -> leaf lookup the encoder builds for integer symbols
+_lut_size = 1 << 20
+
+#longest code of a length limited canonical code, which the decoder reads in
+#one window of the stream
+_max_canonical_bits = 24
+
+#flattens an array or a (nested) list of arrays of different lengths
+def _flatten(array):
+    if isinstance(array, (list, tuple)) and len(array) > 0 and isinstance(array[0], (list, tuple, np.ndarray)):
+        return np.concatenate([_flatten(a) for a in array])
+    return np.asarray(array).ravel()
+
+#returns an encoded stream as a uint8 array followed by 8 zero bytes, and the
+#bit position where its padding starts. Without nbytes the stream is copied
+#once into a padded array. With nbytes, bytarr is a uint8 array or buffer
+#holding the stream in its first nbytes bytes followed by at least 8 zero
+#bytes, and is used as it is
+def _buffer(bytarr, nbytes=None):
+    if nbytes is not None:
+        buf = np.frombuffer(bytarr, dtype=np.uint8)[:nbytes + 8]
+    else:
+        data = np.frombuffer(bytarr, dtype=np.uint8)
+        nbytes = len(data)
+        buf = np.zeros(nbytes + 8, dtype=np.uint8)
+        buf[:nbytes] = data
+    return buf, 8*nbytes - int(buf[0])
+
+#appends the bytes in data to a file-like object or to a resizable one
+#dimensional uint8 h5py dataset
+def _append(sink, data):
+    if hasattr(sink, 'resize'):
+        n = sink.shape[0]
+        sink.resize((n + len(data),))
+        sink[n:] = np.frombuffer(data, dtype=np.uint8)
+    else:
+        sink.write(data)
+
+def _position(sink):
+    if hasattr(sink, 'resize'):
+        return sink.shape[0]
+    return sink.tell()
+
+def _patch(sink, offset, value):
+    if hasattr(sink, 'resize'):
+        sink[offset] = value
+    else:
+        pos = sink.tell()
+        sink.seek(offset)
+        sink.write(bytes([value]))
+        sink.seek(pos)
+
+
+#symbol counts accumulated over any number of arrays, so that a tree can be
+#built for data that never has to be in memory all at once
+class Histogram:
+
+    def __init__(self):
+        self.symbols = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def Add(self, array):
+        self.AddWeights(*np.unique(_flatten(array), return_counts=True))
+
+    def Merge(self, other):
+        self.AddWeights(other.symbols, other.counts)
+
+    def AddWeights(self, symbols, counts):
+        if len(self.symbols) == 0:
+            self.symbols = np.asarray(symbols)
+            self.counts = np.asarray(counts, dtype=np.int64)
+            return
+        self.symbols, inverse = np.unique(np.append(self.symbols, symbols), return_inverse=True)
+        counts = np.append(self.counts, counts)
+        self.counts = np.zeros(len(self.symbols), dtype=np.int64)
+        np.add.at(self.counts, inverse, counts)
 
 
 class Huffman:
 
-    def __init__(self, infile="", nside=256, tree=None, symb=None):
+    def __init__(self, infile="", nside=256, tree=None, symb=None, lengths=None):
         self.infile = infile
         self.nside = nside
-        self.encoding = {}
-        self.decoding = {}
-        self.queue = []
-        self.weight = {}
+        self.weight = []
         self.symbols = []
         self.left_nodes = []
         self.right_nodes = []
         self.node_max = 0
-        self.head_node = None
+        self.table_bits = 0
+        self.table_node = None
+        self.table_len = None
+        #symbol standing in for the values missing from a shared tree
+        self.escape = None
+        #code length of every symbol of a canonical code
+        self.lengths = None
 
         if(tree is not None):
             self.node_max = tree[0]
@@ -65,41 +138,251 @@ class Huffman:
             self.symbols = np.array(symb)
 
         if(symb is not None and tree is not None):
-            self.BuildTree()
-            self.PrintCode(self.head_node)
+            self.BuildTable()
+
+        if(symb is not None and lengths is not None):
+            self.FromLengths(symb, lengths)
 
-    #takes the input tree and symbols and generates the tree structure
+    #takes the input tree and symbols and generates the code tables
     #input arrays are structured so that node numbers 1...nsymb correspond to 
     #the symbols array
     #the left and right arrays indicate the left and right children of nodes
     #nsymb+1 ... 2*nsymb-1
-    def BuildTree(self):
-        nodes = {}
+    #computes the depth and code of every node level by level and fills a
+    #lookup table indexed by the next table_bits bits of the stream. Each
+    #entry holds the leaf whose code prefixes those bits and the code length,
+    #or the internal node reached after table_bits bits for the rare codes
+    #that are longer than the table
+    def BuildTable(self):
         nsymb = len(self.symbols)
-
-        self.head_node = LeafNode(None, 1)
-        self.head_node.node_number = self.node_max
-        self.head_node.left = self.left_nodes[self.node_max-nsymb-1]
-        self.head_node.right = self.right_nodes[self.node_max-nsymb-1]
-        nodes[self.node_max] = self.head_node
-
-        for node in np.append(self.left_nodes, self.right_nodes):
-            currNode = LeafNode(None, 1)
-            currNode.node_number = node
-            if node > nsymb:
-                currNode.left = self.left_nodes[node -nsymb-1]
-                currNode.right= self.right_nodes[node -nsymb-1]
-            else:
-                currNode.symbol = self.symbols[node-1]
-
-            nodes[node] = currNode
-
-        for node in nodes.copy().values():
-            if node.left is not None:
-                node.left = nodes[node.left]
-
-            if node.right is not None:
-                node.right = nodes[node.right]
+        node_max = int(self.node_max)
+
+        self.left_arr = np.zeros(node_max + 1, dtype=np.int64)
+        self.right_arr = np.zeros(node_max + 1, dtype=np.int64)
+        self.left_arr[nsymb+1:] = self.left_nodes
+        self.right_arr[nsymb+1:] = self.right_nodes
+
+        self.depths = np.zeros(node_max + 1, dtype=np.int64)
+        self.codes = np.zeros(node_max + 1, dtype=np.uint64)
+        level = np.array([node_max])
+        while True:
+            level = level[level > nsymb]
+            if len(level) == 0:
+                break
+            for child, bit in ((self.left_arr, 0), (self.right_arr, 1)):
+                self.depths[child[level]] = self.depths[level] + 1
+                self.codes[child[level]] = (self.codes[level] << np.uint64(1)) | np.uint64(bit)
+            level = np.append(self.left_arr[level], self.right_arr[level])
+
+        if self.depths.max() > 57:
+            raise ValueError('Huffman codes longer than 57 bits are not supported')
+
+        self.table_bits = int(min(self.depths[1:nsymb+1].max(), _table_bits))
+        k = self.table_bits
+
+        nodes = np.arange(node_max + 1)
+        entries = np.where(nodes <= nsymb, self.depths <= k, self.depths == k)
+        entries[0] = False
+        nodes = nodes[entries]
+        shift = (k - self.depths[nodes]).astype(np.uint64)
+        order = np.argsort(self.codes[nodes] << shift)
+        nodes = nodes[order]
+        counts = np.left_shift(1, k - self.depths[nodes])
+
+        self.table_node = np.repeat(nodes, counts)
+        self.table_len = np.repeat(self.depths[nodes], counts)
+
+        if self.lengths is not None:
+            self.BuildCanonicalTable()
+        #the encoder's index is built by the first encode, see LeafNodes
+        self.sorted_symbols = None
+        self.symbol_lut = None
+
+    #the codes of each length of a canonical code are consecutive numbers,
+    #assigned to the symbols in order, and left justified to the longest
+    #length they increase with the length. The length of the code at the
+    #start of a window of canonical_bits bits is then the number of limits
+    #canon_limit[L] = (first code + number of codes of length L+1) << (canonical_bits - L - 1)
+    #it is not below, plus one, and its leaf follows from its offset to
+    #the first code of that length
+    def BuildCanonicalTable(self):
+        lengths = np.asarray(self.lengths, dtype=np.int64)
+        m = int(lengths.max()) if len(lengths) > 0 else 0
+        count = np.bincount(lengths, minlength=m + 1)
+        count[0] = 0
+        self.canon_first = np.zeros(m + 1, dtype=np.int64)
+        code = 0
+        for length in range(1, m + 1):
+            code = (code + int(count[length - 1])) << 1
+            self.canon_first[length] = code
+        self.canon_offset = np.cumsum(count) - count
+        self.canon_limit = (self.canon_first[1:] + count[1:]) << (m - np.arange(1, m + 1))
+        self.canon_leaf = np.lexsort((np.arange(len(lengths)), lengths)) + 1
+        self.canonical_bits = m
+
+    #makes the canonical code of symbols with the given code lengths, which
+    #must satisfy the Kraft equality. The tree is built bottom up: the nodes
+    #at each depth, in order of their codes, are the leaves of that length in
+    #symbol order followed by the internal nodes formed by pairing the nodes
+    #one level down in order
+    def FromLengths(self, symbols, lengths):
+        lengths = np.asarray(lengths, dtype=np.int64)
+        nsymb = len(lengths)
+        if nsymb > 0 and lengths.max() > _max_canonical_bits:
+            raise ValueError('Canonical codes longer than ' + str(_max_canonical_bits) + ' bits are not supported')
+        left, right = [], []
+        level = []
+        for depth in range(int(lengths.max()) if nsymb > 0 else 0, 0, -1):
+            if len(level) % 2 != 0:
+                raise ValueError('Code lengths do not form a complete prefix code')
+            internal = list(range(nsymb + 1 + len(left), nsymb + 1 + len(left) + len(level)//2))
+            left += level[0::2]
+            right += level[1::2]
+            level = (np.nonzero(lengths == depth)[0] + 1).tolist() + internal
+        if len(level) == 2:
+            left.append(level[0])
+            right.append(level[1])
+        elif nsymb > 1:
+            raise ValueError('Code lengths do not form a complete prefix code')
+
+        self.symbols = np.asarray(symbols)
+        self.lengths = lengths
+        self.left_nodes = np.array(left, dtype=np.int64)
+        self.right_nodes = np.array(right, dtype=np.int64)
+        self.node_max = max(2*nsymb - 1, 0)
+        self.BuildTable()
+
+    #builds a canonical code of at most maxLength bits from the symbol counts.
+    #The Huffman code lengths are limited as in the JPEG standard: while a
+    #code is too long, two codes of the longest length are replaced by one a
+    #bit shorter and a code of the longest length below them is split in two.
+    #The lengths are then handed out to the symbols in order of weight
+    def CanonicalFromWeights(self, symbols, weight, maxLength=None):
+        if maxLength is None:
+            maxLength = _max_canonical_bits
+        weight = np.asarray(weight)
+        nsymb = len(weight)
+        if maxLength > _max_canonical_bits or nsymb > (1 << maxLength):
+            raise ValueError('Cannot code ' + str(nsymb) + ' symbols in at most ' + str(maxLength) + ' bits')
+
+        left, right = self.MergeNodes(weight)
+        depth = np.zeros(2*nsymb, dtype=np.int64)
+        for node in range(2*nsymb - 1, nsymb, -1):
+            depth[left[node - nsymb - 1]] = depth[node] + 1
+            depth[right[node - nsymb - 1]] = depth[node] + 1
+        lengths = depth[1:nsymb + 1]
+
+        count = np.bincount(lengths, minlength=maxLength + 1)
+        for length in range(len(count) - 1, maxLength, -1):
+            while count[length] > 0:
+                shorter = length - 2
+                while count[shorter] == 0:
+                    shorter -= 1
+                count[length] -= 2
+                count[length - 1] += 1
+                count[shorter + 1] += 2
+                count[shorter] -= 1
+        count = count[:maxLength + 1]
+
+        lengths = np.zeros(nsymb, dtype=np.int64)
+        lengths[np.argsort(-weight, kind='stable')] = np.repeat(np.arange(len(count)), count)
+        self.weight = weight
+        self.FromLengths(symbols, lengths)
+
+    #sorted symbols for the encoder to search, plus a dense lookup table
+    #around the median symbol when the symbols are integers, which covers
+    #the small deltas that make up nearly all of the samples. Built on the
+    #first encode only, as the table takes up to 4 MB that decoders never
+    #use. Encoding threads may race to build it, so sorted_symbols, which
+    #marks it built, is set last
+    def BuildSymbolIndex(self):
+        symbols = np.asarray(self.symbols)
+        order = np.argsort(symbols, kind='stable')
+        sorted_symbols = symbols[order]
+        if symbols.dtype.kind in 'iu' and len(symbols) > 0:
+            centre = int(sorted_symbols[len(symbols)//2])
+            self.lut_offset = max(int(sorted_symbols[0]), centre - _lut_size//2)
+            lut_max = min(int(sorted_symbols[-1]), centre + _lut_size//2 - 1)
+            inside = (symbols >= self.lut_offset) & (symbols <= lut_max)
+            lut = np.zeros(lut_max - self.lut_offset + 1, dtype=np.int32)
+            lut[symbols[inside].astype(np.int64) - self.lut_offset] = np.nonzero(inside)[0] + 1
+            self.symbol_lut = lut
+        self.symbol_order = order
+        self.sorted_symbols = sorted_symbols
+
+    #returns the leaf node number of every code word in the bit range
+    #[start, end) of the uint8 array buf, which must be followed by at least
+    #8 zero bytes. The code length at every bit position of a block is
+    #resolved with the lookup table, and the chain of code word starts through
+    #the block is then found by pointer doubling instead of a bit-by-bit walk.
+    #The 32 bit windows are built from the bytes of one block at a time, so
+    #only the block is ever copied out of buf
+    def DecodeNodes(self, buf, start, end):
+        nsymb = len(self.symbols)
+        if self.table_bits == 0:
+            #single symbol trees have empty codes and decode to nothing
+            return np.zeros(0, dtype=np.int64)
+        k = self.table_bits
+
+        decoded = []
+        p = start
+        while p < end:
+            b1 = min(p + _block_bits, end)
+            q = np.arange(p, b1, dtype=np.int64)
+            #the 32 bits from every byte of the block on, reaching at most 3
+            #bytes past end into the padding
+            lo = p >> 3
+            block = buf[lo:((b1 - 1) >> 3) + 4].astype(np.int64)
+            words = (block[:-3] << 24) | (block[1:-2] << 16) | (block[2:-1] << 8) | block[3:]
+            byte = (q >> 3) - lo
+            window = ((words[byte] << (q & 7)) >> (32 - k)) & ((1 << k) - 1)
+            node = self.table_node[window]
+            length = self.table_len[window].copy()
+
+            idx = np.nonzero(node > nsymb)[0]
+            if self.lengths is not None and len(idx) > 0:
+                #read the codes longer than the table from a window of the
+                #longest code length
+                m = self.canonical_bits
+                w = ((words[byte[idx]] << (q[idx] & 7)) >> (32 - m)) & ((1 << m) - 1)
+                l = np.searchsorted(self.canon_limit, w, side='right') + 1
+                node[idx] = self.canon_leaf[self.canon_offset[l] + (w >> (m - l)) - self.canon_first[l]]
+                length[idx] = l
+                idx = idx[:0]
+
+            #walk the codes longer than the table one bit at a time
+            cur = node[idx]
+            pos = q[idx] + k
+            while len(idx) > 0:
+                bit = (buf[pos >> 3] >> (7 - (pos & 7))) & 1
+                cur = np.where(bit, self.right_arr[cur], self.left_arr[cur])
+                pos += 1
+                done = cur <= nsymb
+                node[idx[done]] = cur[done]
+                length[idx[done]] = pos[done] - q[idx[done]]
+                idx, cur, pos = idx[~done], cur[~done], pos[~done]
+
+            #jumps[i][j] is the bit reached from j after 2**i code words,
+            #with n as the sink for everything past the block
+            n = b1 - p
+            jumps = [np.append(np.minimum(np.arange(n) + length, n), n)]
+            while jumps[-1][0] < n:
+                jumps.append(jumps[-1][jumps[-1]])
+
+            path = np.zeros(1, dtype=np.int64)
+            for jump in jumps[::-1]:
+                path = np.column_stack((path, jump[path])).ravel()
+                path = path[path < n]
+
+            p = int(q[path[-1]] + length[path[-1]])
+            if p > end:
+                #incomplete code word running into the padding
+                path = path[:-1]
+            decoded.append(node[path])
+
+        if len(decoded) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(decoded)
 
     def PixellizePointing(self, diff=True, write=False):
         angs_pol = np.loadtxt(self.infile)
@@ -116,66 +399,191 @@ class Huffman:
         else :
             return pixels
 
+    #returns the distinct values of array and their number of occurrences
     def Weights(self, array):
-        weight = {}
-        for d in array:
-            if not d in weight:
-                    weight[d] = 0
-            weight[d] += 1
-        return weight
-
-    def PrintCode(self, node, code=""):
-
-        if(node.symbol != None):
-            self.encoding[node.symbol] = code
-            self.decoding[code] = node.symbol
-            return
-        self.PrintCode(node.left, code + "0")
-        self.PrintCode(node.right, code + "1")
-
-
+        return np.unique(array, return_counts=True)
+
+    #maps every value of array to the number of the leaf node holding it
+    def SymbolNodes(self, array):
+        nodes = self.LeafNodes(array)
+        if not np.all(nodes):
+            raise KeyError(np.asarray(array)[nodes == 0][0])
+        return nodes
+
+    #as SymbolNodes, with 0 for the values that are not in the tree
+    def LeafNodes(self, array):
+        array = np.asarray(array)
+        if self.sorted_symbols is None:
+            self.BuildSymbolIndex()
+        if self.symbol_lut is not None and array.dtype.kind in 'iu':
+            idx = array.astype(np.int64) - self.lut_offset
+            inside = (idx >= 0) & (idx < len(self.symbol_lut))
+            nodes = self.symbol_lut[np.where(inside, idx, 0)].astype(np.int64)
+            nodes[~inside] = 0
+            missing = np.nonzero(nodes == 0)[0]
+            if len(missing) > 0:
+                nodes[missing] = self.SearchNodes(array[missing])
+            return nodes
+        return self.SearchNodes(array)
+
+    def SearchNodes(self, array):
+        if self.sorted_symbols is None:
+            self.BuildSymbolIndex()
+        idx = np.minimum(np.searchsorted(self.sorted_symbols, array), len(self.sorted_symbols) - 1)
+        found = self.sorted_symbols[idx] == array
+        return np.where(found, self.symbol_order[idx] + 1, 0)
+
+    #returns whether each value of array has a code of its own
+    def Contains(self, array):
+        array = np.asarray(array)
+        found = self.LeafNodes(array) != 0
+        if self.escape is not None:
+            found &= array != self.escape
+        return found
+
+    #replaces the values of array that have no code of their own by the
+    #escape symbol. Returns the new array, the positions of the replaced
+    #values plus offset, and their differences to the escape symbol
+    def Escape(self, array, offset=0):
+        array = _flatten(array)
+        if self.escape is None:
+            return array, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=array.dtype)
+        index = np.nonzero(~self.Contains(array))[0]
+        diff = array[index] - self.escape
+        if len(index) > 0:
+            array = array.copy()
+            array[index] = self.escape
+        return array, index + offset, diff
+
+    #adds the differences of the escaped values back into data decoded from
+    #a stream with escapes, where data starts at sample offset of the stream
+    def Unescape(self, data, index, diff, offset=0):
+        steps = np.append(0, np.cumsum(diff))
+        k = np.searchsorted(index, np.arange(offset, offset + len(data)), side='right')
+        return data + steps[k]
+
+    #packs the codes of the leaf nodes in nodes behind the carry_bits bits
+    #already held in carry_byte. Returns the completed bytes together with
+    #the number of bits and the value of the trailing partial byte
+    def PackCodes(self, nodes, carry_bits=0, carry_byte=0):
+        lengths = self.depths[nodes]
+        ends = carry_bits + np.cumsum(lengths)
+        nbits = int(ends[-1]) if len(ends) > 0 else carry_bits
+        if nbits == carry_bits:
+            return np.zeros(0, dtype=np.uint8), carry_bits, carry_byte
+        starts = ends - lengths
+
+        #codes are at most 57 bits, so each one lies in the 64 bit word
+        #holding its first bit, or straddles into the next word. Every word
+        #is the bitwise or of the consecutive codes starting in it
+        over = (starts & 63) + lengths - 64
+        cross = over > 0
+        codes = self.codes[nodes]
+        head = np.where(cross, codes >> np.maximum(over, 0).astype(np.uint64), codes << np.maximum(-over, 0).astype(np.uint64))
+        word = starts >> 6
+        group = np.nonzero(np.diff(word, prepend=-1))[0]
+        words = np.zeros(nbits//64 + 2, dtype=np.uint64)
+        words[word[group]] = np.bitwise_or.reduceat(head, group)
+        words[word[cross] + 1] |= codes[cross] << (64 - over[cross]).astype(np.uint64)
+
+        packed = words.astype('>u8').view(np.uint8)
+        packed[0] |= carry_byte
+
+        return packed[:nbits//8], nbits % 8, int(packed[nbits//8])
+
+    #encodes array as a leading byte holding the number of padding bits,
+    #followed by the concatenated codes and 1-8 zero padding bits
     def byteCode(self, array):
-        text_bin = "".join(self.encoding[d] for d in array)
-        padding = 8 - len(text_bin) % 8
-        text_bin += padding*"0"
-        text_bin = "{0:08b}".format(padding) + text_bin
-
-        b = bytearray()
-        for i in range(0, len(text_bin), 8):
-            byte = text_bin[i:i+8]
-            b.append(int(byte, 2))
-        return b
-
-
+        b = io.BytesIO()
+        self.StreamCode([array], b)
+        return bytearray(b.getvalue())
+
+    #encodes the arrays yielded by chunks as a single stream in the byteCode
+    #format, appending the bytes to sink as they are completed. sink is a
+    #file-like object or a resizable one dimensional uint8 h5py dataset, and
+    #its padding byte is filled in once the stream length is known. Returns
+    #the number of bytes written
+    def StreamCode(self, chunks, sink):
+        start = _position(sink)
+        _append(sink, bytes(1))
+        carry_bits, carry_byte = 0, 0
+        for chunk in chunks:
+            chunk = _flatten(chunk)
+            for i in range(0, len(chunk), _block_samples):
+                nodes = self.SymbolNodes(chunk[i:i+_block_samples])
+                packed, carry_bits, carry_byte = self.PackCodes(nodes, carry_bits, carry_byte)
+                if len(packed) > 0:
+                    _append(sink, packed.tobytes())
+        _append(sink, bytes([carry_byte]))
+        _patch(sink, start, 8 - carry_bits)
+        return _position(sink) - start
+
+    #builds the Huffman tree of array without encoding it
+    def GenerateTree(self, array):
+        self.TreeFromWeights(*self.Weights(_flatten(array)))
+
+    #builds the Huffman tree of the given symbol counts. All state is local to
+    #the instance, so independent codecs can be built and used from several
+    #threads at once
+    def TreeFromWeights(self, symbols, weight):
+        symbols = np.asarray(symbols)
+        weight = np.asarray(weight)
+        left, right = self.MergeNodes(weight)
+
+        self.symbols = symbols
+        self.weight = weight
+        self.lengths = None
+        self.left_nodes = left
+        self.right_nodes = right
+        self.node_max = 2*len(symbols) - 1
+        self.BuildTable()
+
+    #returns the left and right children of the merged nodes of the Huffman
+    #tree of weight, built with the two queue method: leaves sorted by weight
+    #are merged in order, and since merged weights never decrease the two
+    #lightest nodes are always at the front of the leaf queue or of the queue
+    #of merged nodes. Leaves are numbered 1...nsymb in symbol order and merged
+    #nodes nsymb+1... in order of creation
+    def MergeNodes(self, weight):
+        nsymb = len(weight)
+
+        order = np.argsort(weight, kind='stable')
+        leaf_weight = weight[order].tolist()
+        leaf_node = (order + 1).tolist()
+        merged_weight = []
+        children = [[], []]
+
+        i, j = 0, 0
+        for node in range(nsymb + 1, 2*nsymb):
+            total = 0
+            for child in children:
+                if j >= len(merged_weight) or (i < nsymb and leaf_weight[i] <= merged_weight[j]):
+                    child.append(leaf_node[i])
+                    total += leaf_weight[i]
+                    i += 1
+                else:
+                    child.append(nsymb + 1 + j)
+                    total += merged_weight[j]
+                    j += 1
+            merged_weight.append(total)
+
+        return np.array(children[0], dtype=np.int64), np.array(children[1], dtype=np.int64)
+
+    #builds a tree for data beyond the sample the symbol counts come from,
+    #with an extra escape symbol that stands in for every value outside
+    #symbols. Its weight is the number of symbols seen only once, the
+    #Good-Turing estimate of how often unseen values turn up
+    def EscapeTreeFromWeights(self, symbols, weight):
+        symbols = np.asarray(symbols)
+        weight = np.asarray(weight)
+        escape = symbols.max() + 1 if len(symbols) > 0 else 0
+        self.TreeFromWeights(np.append(symbols, escape), np.append(weight, max(1, np.count_nonzero(weight == 1))))
+        self.escape = escape
+
+    #builds the Huffman tree of array and encodes it
     def GenerateCode(self, array, write=False):
-        array = np.array(array).flatten()
-        self.weight = self.Weights(array)
-
-        global _node_number
-
-        for d in self.weight:
-            node = LeafNode(d, self.weight[d])
-            heapq.heappush(self.queue, node)
-            self.symbols.append(d)
-    
-
-        while(len(self.queue)>1):
-            left_child = heapq.heappop(self.queue)
-            right_child = heapq.heappop(self.queue)
-
-            collapsed = LeafNode(None, left_child.weight + right_child.weight)
-            collapsed.left = left_child
-            collapsed.right = right_child
-            heapq.heappush(self.queue, collapsed)
-
-            self.left_nodes.append(left_child.node_number)
-            self.right_nodes.append(right_child.node_number)
-
-        node = heapq.heappop(self.queue)
-        self.PrintCode(node)
-
-        self.node_max = node.node_number
-        _node_number = 0
+        array = _flatten(array)
+        self.GenerateTree(array)
 
         b = self.byteCode(array)
 
@@ -189,23 +597,14 @@ class Huffman:
         else :
             return bytes(b)
 
-    def Decoder(self, bytarr, write=False):
-        bytarr = bytearray(bytarr)
-        binary_txt = ''.join(bin(i)[2:].rjust(8,'0') for i in bytarr)
-        padding = int(binary_txt[:8], 2)
-        binary_txt = binary_txt[8:-1*padding]
-
-        decoded_arr = []
-        code = ""
-
-        for b in binary_txt:
-            code += b
-            if code in self.decoding:
-                d = self.decoding[code]
-                decoded_arr.append(d)
-                code = ""
-
-        decoded_arr = np.cumsum(decoded_arr)
+    #decodes the stream in bytarr, see _buffer for nbytes. The samples are
+    #written to out if it is given, which must have their number of elements
+    def Decoder(self, bytarr, write=False, out=None, nbytes=None):
+        buf, end = _buffer(bytarr, nbytes)
+        values = np.asarray(self.symbols)[self.DecodeNodes(buf, 8, end) - 1]
+        if out is not None and len(out) != len(values):
+            raise ValueError('Output array of length ' + str(len(out)) + ' does not fit ' + str(len(values)) + ' decoded samples')
+        decoded_arr = np.cumsum(values, out=out)
 
         if write:
             fname, fext = os.path.splitext(self.infile)
@@ -214,3 +613,77 @@ class Huffman:
             return decoded_arr, file_out
         else:
             return decoded_arr
+
+    #returns the bit offset of every step-th sample of the stream encoded
+    #from chunks, and the sum of all samples before it, from which decoding
+    #can start without touching the rest of the stream, together with the
+    #number of samples in the stream
+    def SyncPoints(self, chunks, step):
+        bits, values = [], []
+        offset, total, n = 8, 0, 0
+        for chunk in chunks:
+            chunk = _flatten(chunk)
+            if len(chunk) == 0:
+                continue
+            lengths = self.depths[self.SymbolNodes(chunk)]
+            ends = offset + np.cumsum(lengths)
+            sums = total + np.cumsum(chunk)
+            idx = np.arange((-n) % step, len(chunk), step)
+            bits.append(ends[idx] - lengths[idx])
+            values.append(sums[idx] - chunk[idx])
+            offset, total, n = ends[-1], sums[-1], n + len(chunk)
+        if len(bits) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.asarray(self.symbols).dtype), n
+        return np.concatenate(bits), np.concatenate(values), n
+
+    #decodes samples start...stop-1 of a stream of n samples with the given
+    #sync points, starting from the last sync point before start and stopping
+    #at the first one after stop. start and stop are taken as in a slice of
+    #the n samples, so they may be negative or out of range
+    def DecodeSlice(self, bytarr, sync_bits, sync_values, step, n, start=None, stop=None, nbytes=None):
+        start, stop, _ = slice(start, stop).indices(n)
+        if stop <= start:
+            return sync_values[:0] + np.cumsum(np.asarray(self.symbols)[:0])
+        buf, end = _buffer(bytarr, nbytes)
+        first = start // step
+        last = min(-(-stop // step), len(sync_bits))
+
+        bit1 = sync_bits[last] if last < len(sync_bits) else end
+        nodes = self.DecodeNodes(buf, int(sync_bits[first]), int(bit1))
+        data = sync_values[first] + np.cumsum(np.asarray(self.symbols)[nodes - 1])
+        return data[start - first*step:stop - first*step]
+
+    #decodes a whole stream with sync points by splitting it into nparts
+    #pieces between sync points, decoded by the workers of pool
+    def DecodeParallel(self, bytarr, sync_bits, sync_values, pool, nparts=None, nbytes=None):
+        buf, end = _buffer(bytarr, nbytes)
+        if nparts is None:
+            nparts = os.cpu_count()
+        bounds = np.append(sync_bits, end)
+        parts = np.unique(np.linspace(0, len(sync_bits), nparts + 1).astype(np.int64))
+
+        args = []
+        for a, b in zip(parts[:-1], parts[1:]):
+            lo, hi = bounds[a] >> 3, (bounds[b] + 7) >> 3
+            args.append((self, buf[lo:hi].tobytes(), int(bounds[a] - 8*lo), int(bounds[b] - 8*lo), sync_values[a]))
+        return np.concatenate(pool.starmap(_decode_segment, args))
+
+    #codecs are sent to other processes as their tree and symbols only, the
+    #lookup tables are rebuilt on arrival
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['left_arr', 'right_arr', 'depths', 'codes', 'table_node', 'table_len', 'symbol_order', 'sorted_symbols', 'symbol_lut', 'canon_first', 'canon_offset', 'canon_limit', 'canon_leaf']:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.table_node = None
+        self.table_len = None
+        if len(self.symbols) > 0:
+            self.BuildTable()
+
+#decodes the bits [start, end) of data with h, offset by value
+def _decode_segment(h, data, start, end, value):
+    buf = np.append(np.frombuffer(data, dtype=np.uint8), np.zeros(8, dtype=np.uint8))
+    return value + np.cumsum(np.asarray(h.symbols)[h.DecodeNodes(buf, start, end) - 1])
@@ -0,0 +1,137 @@
+#================================================================================
+#
+# Copyright (C) 2020 Institute of Theoretical Astrophysics, University of Oslo.
+#
+# This file is part of Commander3.
+#
+# Commander3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Commander3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Commander3. If not, see <https://www.gnu.org/licenses/>.
+#
+#================================================================================
+
+import numpy as np
+
+#lower bound of the coder states, which stay in [_state_low, _state_low << 16)
+_state_low = np.uint64(1 << 16)
+
+#default number of samples coded by every lane
+_steps = 2048
+
+#range asymmetric numeral system coder for integer streams. Unlike Huffman
+#codes it spends fractional bits per sample, so it keeps compressing streams
+#that are almost constant.
+#The samples are dealt round robin to independent coders (lanes), each with
+#a 32 bit state that is renormalized by whole 16 bit words. The lanes are
+#advanced together, so a stream of n samples takes about n/lanes vectorized
+#steps. The symbol frequencies, quantized to sum to 2**scaleBits, and the
+#final states are stored in the stream, so it decodes on its own
+class rANS:
+
+    def __init__(self, scaleBits=16, lanes=None):
+        if scaleBits < 1 or scaleBits > 16:
+            raise ValueError('rANS scaleBits must be between 1 and 16')
+        self.scaleBits = scaleBits
+        self.lanes = lanes
+
+    #scales counts to frequencies of at least 1 summing to 2**scaleBits
+    def Quantize(self, counts):
+        total = 1 << self.scaleBits
+        if len(counts) > total:
+            raise ValueError(str(len(counts)) + ' symbols do not fit in rANS frequencies of ' + str(self.scaleBits) + ' bits')
+        counts = np.asarray(counts, dtype=np.int64)
+        freqs = np.maximum(1, counts * total // np.sum(counts))
+        diff = total - np.sum(freqs)
+        if diff > 0:
+            #round up the symbols that lost the most to the floor
+            order = np.argsort(freqs - counts * total / np.sum(counts))
+            freqs[order[:diff]] += 1
+        while diff < 0:
+            #take back from the most frequent symbols, which lose the least
+            order = np.argsort(freqs)[::-1][:-diff]
+            order = order[freqs[order] > 1]
+            freqs[order] -= 1
+            diff = total - np.sum(freqs)
+        return freqs
+
+    #codes the integers in array, which must fit in 64 bit signed integers.
+    #Anything else would be cast to them and decode to other values
+    def Encode(self, array):
+        array = np.asarray(array).ravel()
+        if array.dtype.kind not in 'iu':
+            raise ValueError('rANS only codes integers, not ' + str(array.dtype))
+        if array.dtype.kind == 'u' and len(array) > 0 and array.max() > np.iinfo(np.int64).max:
+            raise ValueError('rANS only codes integers that fit in 64 bit signed integers')
+        n = len(array)
+        symbols, inverse, counts = np.unique(array, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        freqs = self.Quantize(counts) if n > 0 else np.zeros(0, dtype=np.int64)
+        lanes = self.lanes if self.lanes is not None else max(1, -(-n // _steps))
+        steps = -(-n // lanes)
+
+        slots = np.zeros(steps*lanes, dtype=np.int64)
+        slots[:n] = inverse
+        slots = slots.reshape(steps, lanes)
+        freq = freqs.astype(np.uint64)[slots]
+        cum = (np.cumsum(freqs) - freqs).astype(np.uint64)[slots]
+
+        bits = np.uint64(self.scaleBits)
+        word = np.uint64(16)
+        xmax = np.uint64(1 << (32 - self.scaleBits))
+        x = np.full(lanes, _state_low, dtype=np.uint64)
+        blocks = []
+        #the decoder runs forwards, so the samples are coded backwards
+        for t in range(steps - 1, -1, -1):
+            m = lanes if t < steps - 1 else n - t*lanes
+            xs = x[:m]
+            f = freq[t,:m]
+            emit = xs >= f * xmax
+            blocks.append((xs[emit] & np.uint64(0xffff)).astype('<u2'))
+            xs[emit] >>= word
+            x[:m] = ((xs // f) << bits) + xs % f + cum[t,:m]
+
+        header = np.array([n, lanes, self.scaleBits, len(symbols)], dtype='<u8')
+        words = np.concatenate(blocks[::-1]) if len(blocks) > 0 else np.zeros(0, dtype='<u2')
+        return b''.join([header.tobytes(), symbols.astype('<i8').tobytes(), (freqs - 1).astype('<u2').tobytes(), x.astype('<u4').tobytes(), words.tobytes()])
+
+    def Decode(self, bytarr):
+        buf = np.frombuffer(bytarr, dtype=np.uint8)
+        n, lanes, scaleBits, nsymb = [int(v) for v in np.frombuffer(buf, dtype='<u8', count=4)]
+        pos = 32
+        symbols = np.frombuffer(buf, dtype='<i8', count=nsymb, offset=pos)
+        pos += 8*nsymb
+        freqs = np.frombuffer(buf, dtype='<u2', count=nsymb, offset=pos).astype(np.uint64) + np.uint64(1)
+        pos += 2*nsymb
+        x = np.frombuffer(buf, dtype='<u4', count=lanes, offset=pos).astype(np.uint64)
+        pos += 4*lanes
+        words = np.frombuffer(buf, dtype='<u2', offset=pos).astype(np.uint64)
+
+        cum = np.cumsum(freqs) - freqs
+        slot_symbol = np.repeat(np.arange(nsymb), freqs.astype(np.int64))
+        bits = np.uint64(scaleBits)
+        mask = np.uint64((1 << scaleBits) - 1)
+        word = np.uint64(16)
+        steps = -(-n // lanes)
+        out = np.zeros((steps, lanes), dtype=np.int64)
+        p = 0
+        for t in range(steps):
+            m = lanes if t < steps - 1 else n - t*lanes
+            xs = x[:m]
+            slot = xs & mask
+            s = slot_symbol[slot]
+            out[t,:m] = s
+            xs = freqs[s] * (xs >> bits) + slot - cum[s]
+            need = np.nonzero(xs < _state_low)[0]
+            xs[need] = (xs[need] << word) | words[p:p+len(need)]
+            p += len(need)
+            x[:m] = xs
+        return symbols[out.ravel()[:n]]
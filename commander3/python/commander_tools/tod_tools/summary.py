@@ -0,0 +1,111 @@
+#================================================================================
+#
+# Copyright (C) 2020 Institute of Theoretical Astrophysics, University of Oslo.
+#
+# This file is part of Commander3.
+#
+# Commander3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Commander3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Commander3. If not, see <https://www.gnu.org/licenses/>.
+#
+#================================================================================
+
+# Summary statistics of fields, gathered from their raw samples while they
+# are written, so the fields can be checked without decoding them
+
+import numpy as np
+
+#columns of a table of field statistics, without the field name that leads
+#every row. var is the variance over count (not count - 1), flagged the
+#fraction of samples with any bit of flagMask set and unique the number of
+#distinct values. Statistics that were not asked for are nan, or -1 for
+#unique, and the flagMask of a row without flagged is 0
+statColumns = [('count', np.int64), ('min', np.float64), ('max', np.float64), ('mean', np.float64), ('var', np.float64), ('flagged', np.float64), ('flagMask', np.int64), ('unique', np.int64)]
+
+#samples per block the statistics are accumulated over, which bounds the
+#temporary arrays they need
+_blockSamples = 1 << 16
+
+#statistics of a field accumulated over consecutive pieces of its samples,
+#with the mean and variance merged piece by piece (Chan et al.). flagMask
+#selects the bits counted as flagged and unique whether the distinct values
+#are counted, which keeps every one of them until row is called
+class field_summary:
+
+    def __init__(self, flagMask=None, unique=False):
+        self.flagMask = flagMask
+        self.count = 0
+        self.min = np.nan
+        self.max = np.nan
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.flagged = 0
+        self.unique = unique
+        self.values = None
+
+    def add(self, data):
+        data = np.asarray(data).ravel()
+        if data.dtype.kind not in 'biuf':
+            raise ValueError('Only numbers can be summarized, not ' + str(data.dtype))
+        if self.flagMask is not None and data.dtype.kind not in 'biu':
+            raise ValueError('Only integers can be counted as flagged, not ' + str(data.dtype))
+        for start in range(0, len(data), _blockSamples):
+            block = data[start:start + _blockSamples]
+            n = len(block)
+            blockMean = np.mean(block, dtype=np.float64)
+            blockM2 = float(np.sum(np.square(block - blockMean, dtype=np.float64)))
+            if self.count == 0:
+                self.min, self.max = float(np.min(block)), float(np.max(block))
+            else:
+                self.min = float(np.minimum(self.min, np.min(block)))
+                self.max = float(np.maximum(self.max, np.max(block)))
+            total = self.count + n
+            delta = blockMean - self.mean
+            self.mean += delta*n/total
+            self.m2 += blockM2 + delta*delta*self.count*n/total
+            self.count = total
+            if self.flagMask is not None:
+                self.flagged += int(np.count_nonzero(block & self.flagMask))
+            if self.unique:
+                values = distinct(block)
+                self.values = values if self.values is None else distinct(np.concatenate([self.values, values]))
+        return self
+
+    #the statistics as a tuple in the order of statColumns
+    def row(self):
+        if self.count == 0:
+            return (0, np.nan, np.nan, np.nan, np.nan, np.nan, 0, 0 if self.unique else -1)
+        flagged = np.nan if self.flagMask is None else self.flagged/self.count
+        return (self.count, self.min, self.max, self.mean, self.m2/self.count, flagged, 0 if self.flagMask is None else int(self.flagMask), len(self.values) if self.unique else -1)
+
+#the distinct values of data, sorted. Faster than np.unique, which also
+#sorts but does more around it
+def distinct(data):
+    data = np.sort(data)
+    if len(data) < 2:
+        return data
+    return data[np.append(True, data[1:] != data[:-1])]
+
+#returns the statistics of data as a field_summary, with the options of the
+#stats argument of commander_tod.add_field
+def summarize(data, stats):
+    return field_summary(stats.get('flagMask'), stats.get('unique', False)).add(data)
+
+#a table of field statistics from a dict of field_summary by field name, as
+#a structured array with a leading field column
+def stats_table(summaries):
+    names = [name.encode() for name in summaries.keys()]
+    width = max([len(name) for name in names] + [1])
+    table = np.zeros(len(names), dtype=[('field', 'S' + str(width))] + statColumns)
+    for i, (name, summary) in enumerate(zip(names, summaries.values())):
+        table[i] = (name,) + summary.row()
+    return table
@@ -0,0 +1,217 @@
+#================================================================================
+#
+# Copyright (C) 2020 Institute of Theoretical Astrophysics, University of Oslo.
+#
+# This file is part of Commander3.
+#
+# Commander3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Commander3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Commander3. If not, see <https://www.gnu.org/licenses/>.
+#
+#================================================================================
+
+# Compares the throughput of the commander_tools huffman codec against the
+# original string based implementation in todscripts/huffman.py, and against
+# the rANS entropy coder
+
+from commander_tools.tod_tools import huffman
+from commander_tools.tod_tools import rans
+import huffman as legacy_huffman
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import numpy as np
+import time
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--nsamp', type=int, action='store', default=1000000, help='number of samples per test stream')
+
+    parser.add_argument('--nrep', type=int, action='store', default=3, help='number of timing repetitions, the fastest is reported')
+
+    parser.add_argument('--seed', type=int, action='store', default=0, help='random seed for the synthetic streams')
+
+    parser.add_argument('--threads', type=int, action='store', default=4, help='number of threads for the concurrent round trip check')
+
+    parser.add_argument('--npids', type=int, action='store', default=20, help='number of pids in the shared dictionary comparison')
+
+    parser.add_argument('--ntrain', type=int, action='store', default=4, help='number of pids the shared dictionaries are trained on')
+
+    in_args = parser.parse_args()
+
+    rng = np.random.default_rng(in_args.seed)
+    streams = make_streams(rng, in_args.nsamp)
+
+    check_threads(streams, in_args.threads)
+
+    check_slices(streams)
+
+    for name, data in streams.items():
+        delta = np.diff(data)
+        delta = np.insert(delta, 0, data[0])
+
+        h_old = legacy_huffman.Huffman('')
+        t_old, code = best_time(h_old.GenerateCode, delta, nrep=1)
+        t_new, code_new = best_time(huffman.Huffman().GenerateCode, delta, nrep=in_args.nrep)
+
+        report(name, 'build tree and encode', len(code), t_old, t_new)
+
+        #time the encoder and decoder on the reference tree
+        tree = np.append(np.append(np.array(h_old.node_max), h_old.left_nodes), h_old.right_nodes)
+        h_new = huffman.Huffman(tree=tree, symb=h_old.symbols)
+
+        t_old, code_old = best_time(h_old.byteCode, delta, nrep=1)
+        t_new, code_new = best_time(h_new.byteCode, delta, nrep=in_args.nrep)
+
+        if bytes(code_old) != bytes(code_new):
+            raise ValueError('Encoded ' + name + ' stream differs from the reference encoder')
+
+        report(name, 'encode', len(code), t_old, t_new)
+
+        t_old, out_old = best_time(h_old.Decoder, bytearray(code), nrep=1)
+        t_new, out_new = best_time(h_new.Decoder, np.void(code), nrep=in_args.nrep)
+
+        if not np.array_equal(out_old, out_new):
+            raise ValueError('Decoded ' + name + ' stream differs from the reference decoder')
+
+        report(name, 'decode', len(code), t_old, t_new)
+
+    compare_shared(rng, in_args.nsamp, in_args.npids, in_args.ntrain)
+
+    compare_coders(streams, in_args.nrep)
+
+#reports the bits per sample and the encoding and decoding rate of the
+#differenced streams, in MB/s of the original data, for every entropy coder
+def compare_coders(streams, nrep):
+    for name, data in streams.items():
+        delta = np.diff(data, prepend=0)
+        mbytes = data.nbytes/1e6
+
+        h = huffman.Huffman()
+        t_enc, code = best_time(h.GenerateCode, delta, nrep=nrep)
+        t_dec, out = best_time(h.Decoder, np.void(code), nrep=nrep)
+        if not np.array_equal(out, data):
+            raise ValueError('Huffman round trip of ' + name + ' failed')
+        print(name + ' huffman: ' + '{:.3f}'.format(8*len(code)/len(data)) + ' bits/sample, encode ' + '{:.1f}'.format(mbytes/t_enc) + ' MB/s, decode ' + '{:.1f}'.format(mbytes/t_dec) + ' MB/s')
+
+        r = rans.rANS()
+        t_enc, code = best_time(r.Encode, delta, nrep=nrep)
+        t_dec, out = best_time(r.Decode, code, nrep=nrep)
+        if not np.array_equal(np.cumsum(out), data):
+            raise ValueError('rANS round trip of ' + name + ' failed')
+        print(name + ' rans: ' + '{:.3f}'.format(8*len(code)/len(data)) + ' bits/sample, encode ' + '{:.1f}'.format(mbytes/t_enc) + ' MB/s, decode ' + '{:.1f}'.format(mbytes/t_dec) + ' MB/s')
+
+#compares the total size and encoding time of npids streams of every kind
+#coded with a tree per pid and with one dictionary trained on ntrain of them
+def compare_shared(rng, nsamp, npids, ntrain):
+    pids = [make_streams(rng, nsamp) for i in range(npids)]
+    for name in pids[0].keys():
+        deltas = [np.diff(streams[name], prepend=0) for streams in pids]
+
+        t0 = time.time()
+        size = 0
+        for delta in deltas:
+            h = huffman.Huffman()
+            size += len(h.GenerateCode(delta)) + tree_bytes(h)
+        t_pid = time.time() - t0
+
+        t0 = time.time()
+        hist = huffman.Histogram()
+        for delta in deltas[:ntrain]:
+            hist.Add(delta)
+        h = huffman.Huffman()
+        h.EscapeTreeFromWeights(hist.symbols, hist.counts)
+        t_train = time.time() - t0
+        shared_size = tree_bytes(h)
+        nescape = 0
+        for delta in deltas:
+            delta, index, diff = h.Escape(delta)
+            shared_size += len(h.byteCode(delta)) + index.nbytes + diff.nbytes
+            nescape += len(index)
+        t_shared = time.time() - t0
+
+        print(name + ' over ' + str(npids) + ' pids: ' + str(size) + ' bytes in ' + '{:.2f}'.format(t_pid) + ' s with a tree per pid, ' + str(shared_size) + ' bytes in ' + '{:.2f}'.format(t_shared) + ' s (' + '{:.2f}'.format(t_train) + ' s training) with a shared tree, ' + '{:.2e}'.format(nescape/(npids*nsamp)) + ' of the samples escaped')
+
+def tree_bytes(h):
+    return 8*(1 + len(h.left_nodes) + len(h.right_nodes)) + np.asarray(h.symbols).nbytes
+
+#builds, encodes and decodes every stream with its own codec from a pool of
+#threads and checks that all of them round trip
+def check_threads(streams, nthreads):
+    jobs = list(streams.values())*nthreads
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        results = list(pool.map(round_trip, jobs))
+    for data, out in zip(jobs, results):
+        if not np.array_equal(data, out):
+            raise ValueError('Concurrent round trip failed')
+    print(str(len(jobs)) + ' streams round tripped on ' + str(nthreads) + ' threads in ' + '{:.2f}'.format(time.time() - t0) + ' s')
+
+#decodes slices of every stream from its sync points, with bounds that are
+#negative, empty or out of range, and checks them against numpy's slicing
+def check_slices(streams, step=1000):
+    for name, data in streams.items():
+        n = len(data)
+        delta = np.diff(data, prepend=0)
+        h = huffman.Huffman()
+        code = h.GenerateCode(delta)
+        sync_bits, sync_values, _ = h.SyncPoints([delta], step)
+        for start, stop in [(None, None), (step + 1, 3*step - 1), (None, -100), (-1000, -10), (-100, None), (-n - 10, 10), (n - 1, None), (n, None), (n + 10, n + 20), (10, 5), (0, n + 10)]:
+            out = h.DecodeSlice(np.void(code), sync_bits, sync_values, step, n, start, stop)
+            if not np.array_equal(out, data[start:stop]):
+                raise ValueError('Slice ' + str(start) + ':' + str(stop) + ' of ' + name + ' decoded wrong')
+    print('slices of ' + str(len(streams)) + ' streams decoded from their sync points')
+
+def round_trip(data):
+    delta = np.diff(data)
+    delta = np.insert(delta, 0, data[0])
+    h = huffman.Huffman()
+    code = h.GenerateCode(delta)
+    tree = np.append(np.append(np.array(h.node_max), h.left_nodes), h.right_nodes)
+    return huffman.Huffman(tree=tree, symb=h.symbols).Decoder(np.void(code))
+
+def report(name, step, nbytes, t_old, t_new):
+    mbytes = nbytes/1e6
+    print(name + ': ' + str(nbytes) + ' bytes, ' + step + ' ' + '{:.2f}'.format(mbytes/t_old) + ' MB/s (old) ' + '{:.2f}'.format(mbytes/t_new) + ' MB/s (new), speedup ' + '{:.1f}'.format(t_old/t_new))
+
+#synthetic streams with the statistics of the compressed LFI fields
+def make_streams(rng, nsamp):
+    t = np.arange(nsamp)
+    #smooth ring scan at ~1 rpm, sampled at 78 Hz
+    phi = 2*np.pi*t/(60*78.)
+    theta = np.pi/2 + 0.7*np.sin(phi)
+    pix = np.int64(1024*(theta + 4*np.pi*t/nsamp))
+
+    psi = np.digitize(np.mod(phi + rng.normal(0, 1e-3, nsamp), 2*np.pi), np.linspace(0, 2*np.pi, 4096))
+
+    tod = np.int32(100*rng.normal(0, 1, nsamp))
+
+    #mostly clear flags, with a few stretches of ~100 flagged samples
+    starts = rng.integers(0, nsamp, max(1, nsamp//5000))
+    edges = np.zeros(nsamp + 100, dtype=np.int64)
+    np.add.at(edges, starts, 1)
+    np.add.at(edges, starts + 100, -1)
+    flag = 4*np.int64(np.cumsum(edges)[:nsamp] > 0)
+
+    return {'pix':pix, 'psi':psi, 'tod':tod, 'flag':flag}
+
+def best_time(func, *args, nrep=3):
+    times = []
+    for i in range(nrep):
+        t0 = time.time()
+        out = func(*args)
+        times.append(time.time() - t0)
+    return min(times), out
+
+if __name__ == '__main__':
+    main()
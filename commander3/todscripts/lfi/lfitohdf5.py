@@ -21,6 +21,7 @@
 
 from commander_tools.tod_tools.lfi import lfi
 from commander_tools.tod_tools import commander_tod as tod
+from commander_tools.tod_tools import huffman
 import argparse
 import multiprocessing as mp
 import os
@@ -58,10 +59,30 @@ def main():
 
     parser.add_argument('--no-compress-tod', action='store_true', default=False, help='should we compress the tod field')
 
-    parser.add_argument('--restart', action='store_true', default=False, help="restart from a previous run that didn't finish")
+    parser.add_argument('--hdf5-filter', type=str, action='store', default=None, choices=['gzip', 'lzf'], help='hdf5 filter for the tod, theta and phi fields written uncompressed. Only gzip is readable by commander')
+
+    parser.add_argument('--flag-compression', type=str, action='store', default='huffman', choices=['huffman'] + tod.flagSteps, help='compression of the flag field. rle and packbits are much smaller and faster to decode but are not understood by commander')
+
+    parser.add_argument('--write-queue', type=int, action='store', default=0, help='number of encoded pids that may wait to be written by a background thread while the next ones are encoded, 0 writes every pid before encoding the next')
+
+    parser.add_argument('--restart', action='store_true', default=False, help="restart from a previous run that didn't finish, keeping the finished files and the pids committed to unfinished ones")
+
+    parser.add_argument('--incremental', action='store_true', default=False, help='keep the files and pids whose inputs, compression and code are unchanged since they were written, and convert only the rest')
+
+    parser.add_argument('--hash-inputs', action='store_true', default=False, help='identify the input files by the sha1 of their contents rather than their size and modification time, which survives copying them but reads them twice')
+
+    parser.add_argument('--stats', action='store_true', default=False, help='store summary statistics of the flag, pix, psi and tod fields of every pid, gathered before they are compressed, which tod_stats checks without decoding the fields')
 
     parser.add_argument('--produce-filelist', action='store_true', default=False, help='force the production of a filelist even if only some files are present')
 
+    parser.add_argument('--ranks', type=int, nargs='+', default=[], help='also write the assignments of the pids to these numbers of commander processes with the filelists')
+
+    parser.add_argument('--shared-dicts', action='store_true', default=False, help='train one huffman dictionary per frequency and field type on a sample of ods and share it between the pids. The dictionaries are saved in the output directory and reused by --restart and --incremental')
+
+    parser.add_argument('--train-ods', type=int, action='store', default=20, help='number of ods per frequency the shared dictionaries are trained on')
+
+    parser.add_argument('--max-escape', type=float, action='store', default=0, help='largest fraction of samples of a pid missing from a shared dictionary before the pid gets its own tree. Escaped samples are not understood by commander')
+
     in_args = parser.parse_args()
 
     in_args.version = 5
@@ -80,8 +101,12 @@ def main():
 
     manager = mp.Manager()
     dicts = {30:manager.dict(), 44:manager.dict(), 70:manager.dict()}
+    catalogs = {30:manager.dict(), 44:manager.dict(), 70:manager.dict()}
 
-    comm_tod = tod.commander_tod(in_args.out_dir, in_args.version, dicts, not in_args.restart)
+    comm_tod = tod.commander_tod(in_args.out_dir, in_args.version, dicts, not (in_args.restart or in_args.incremental), catalogs=catalogs, memmap=in_args.no_compress, writeQueue=in_args.write_queue)
+
+    if in_args.shared_dicts and not in_args.no_compress:
+        train_dicts(comm_tod, pool, ods, in_args)
 
     x = [[pool.apply_async(make_od, args=[comm_tod, freq, od, in_args]) for freq in in_args.freqs] for od in ods]
 
@@ -92,10 +117,47 @@ def main():
     pool.close()
     pool.join()
 
+    comm_tod.make_catalogs()
+
     if ((in_args.ods[0] == 91 and in_args.ods[1] == 1604) or in_args.produce_filelist) :
-        comm_tod.make_filelists()
+        comm_tod.make_filelists(ranks=in_args.ranks)
         #write file lists 
 
+#counts the symbols of every huffman dictionary in a random sample of ods on
+#the pool and sets the shared dictionaries of comm_tod from the totals, which
+#are saved with the output. A restarted or incremental run reuses the saved
+#ones, as the pids already written link to them
+def train_dicts(comm_tod, pool, ods, args):
+    freqs = args.freqs
+    if args.restart or args.incremental:
+        freqs = [freq for freq in args.freqs if not comm_tod.load_dictionaries(freq, args.max_escape)]
+        for freq in args.freqs:
+            if freq not in freqs:
+                print('Reusing the dictionaries in ' + comm_tod.dictionary_name(freq))
+    if len(freqs) == 0:
+        return
+
+    trainer = tod.huffman_trainer()
+    train_ods = random.sample(list(ods), min(args.train_ods, len(ods)))
+    x = [pool.apply_async(train_od, args=[trainer, freq, od, args]) for freq in freqs for od in train_ods]
+
+    hists = {}
+    for res in x:
+        for key, hist in res.get().items():
+            if key not in hists.keys():
+                hists[key] = huffman.Histogram()
+            hists[key].Merge(hist)
+
+    for (freq, dictNum), hist in hists.items():
+        comm_tod.set_dictionary(freq, dictNum, hist, args.max_escape)
+        print('Trained dictionary ' + str(dictNum) + ' at ' + str(freq) + ' GHz with ' + str(len(hist.symbols)) + ' symbols from ' + str(np.sum(hist.counts)) + ' samples')
+    for freq in freqs:
+        comm_tod.save_dictionaries(freq, {dictNum:hist for (dictFreq, dictNum), hist in hists.items() if dictFreq == freq})
+
+def train_od(trainer, freq, od, args):
+    make_od(trainer, freq, od, args)
+    return trainer.hists
+
 def make_od(comm_tod, freq, od, args):
 
     print(freq, od)
@@ -104,13 +166,19 @@ def make_od(comm_tod, freq, od, args):
 
     comm_tod.init_file(freq, od, mode='w')
 
-    if(args.restart and comm_tod.exists):
+    if(args.restart and comm_tod.exists and not args.incremental):
         comm_tod.finalize_file()
         print('Skipping existing file ' + comm_tod.outName)
         return
 
     rimo = fits.open(args.rimo)
 
+    #a file made from other inputs, compression or code is started over
+    if comm_tod.set_provenance(od_provenance(comm_tod, freq, od, rimo, args)):
+        print('Checking ' + str(len(comm_tod.pids)) + ' pids of ' + comm_tod.outName)
+    elif len(comm_tod.pids) > 0:
+        print('Resuming ' + comm_tod.outName + ' after ' + str(len(comm_tod.pids)) + ' pids')
+
     if args.velocity_file is not None:
         velFile = fits.open(args.velocity_file)
 
@@ -126,10 +194,12 @@ def make_od(comm_tod, freq, od, args):
 
     #sampling frequency
     fsamp = rimo[1].data.field('f_samp')[rimo_i]
-    comm_tod.add_field(prefix + '/fsamp', fsamp)
+    #a file kept by an incremental conversion has its common fields already
+    if not comm_tod.exists:
+        comm_tod.add_field(prefix + '/fsamp', fsamp)
 
-    #nside
-    comm_tod.add_field(prefix + '/nside', [nside])
+        #nside
+        comm_tod.add_field(prefix + '/nside', [nside])
 
     detNames = ''
     polangs = []
@@ -146,16 +216,27 @@ def make_od(comm_tod, freq, od, args):
     if args.no_compress:
         compArr = None
 
-    #make detector names lookup
-    comm_tod.add_field(prefix + '/det', np.string_(detNames[0:-2]))
+    #filter of the fields written uncompressed
+    hdf5Comp = None
+    if args.hdf5_filter is not None:
+        hdf5Comp = [['hdf5', {'filter':args.hdf5_filter, 'shuffle':True}]]
+
+    if not comm_tod.exists:
+        #make detector names lookup
+        comm_tod.add_field(prefix + '/det', np.string_(detNames[0:-2]))
 
-    #make polarization angle
-    comm_tod.add_field(prefix + '/polang', polangs)
-    comm_tod.add_attribute(prefix + '/polang', 'index', detNames[0:-2])
+        #make polarization angle
+        comm_tod.add_field(prefix + '/polang', polangs)
+        comm_tod.add_attribute(prefix + '/polang', 'index', detNames[0:-2])
 
-    #make main beam angle
-    comm_tod.add_field(prefix + '/mbang', mainbeamangs)
-    comm_tod.add_attribute(prefix + '/mbang', 'index', detNames[0:-2])
+        #make main beam angle
+        comm_tod.add_field(prefix + '/mbang', mainbeamangs)
+        comm_tod.add_attribute(prefix + '/mbang', 'index', detNames[0:-2])
+
+    #open per freq npipe gains file if required
+    gainsFile = None
+    if args.gains_dir is not None and "npipe" in args.gains_dir:#this is a shitty test
+        gainsFile = fits.open(os.path.join(args.gains_dir, 'gains_0' + str(freq) + '_iter01.fits'))
 
     try:
         exFile = h5py.File(os.path.join(args.planck_dir, 'LFI_0' + str(freq) + '_' + str(lfi.horns[freq][0]) + '_L2_002_OD' + str(od).zfill(4) +'.h5'), 'r')
@@ -165,6 +246,9 @@ def make_od(comm_tod, freq, od, args):
 
     #per pid
     for pid, index in zip(exFile['AHF_info/PID'], range(len(exFile['AHF_info/PID']))):
+        if pid in comm_tod.pids and not args.incremental:
+            #committed before the conversion was interrupted
+            continue
         startIndex = np.where(exFile['Time/OBT'] > exFile['AHF_info/PID_start'][index])
         endIndex = np.where(exFile['Time/OBT'] > exFile['AHF_info/PID_end'][index])
         if len(startIndex[0]) > 0:
@@ -179,6 +263,22 @@ def make_od(comm_tod, freq, od, args):
             continue
 
         obt = exFile['Time/OBT'][pid_start]
+        velIndex = np.where(velFile[1].data.scet > exFile['Time/SCET'][pid_start])[0][0]
+        posIndex = np.where(posArray[0] > exFile['Time/MJD'][pid_start])[0][0]
+        gains = {}
+        for horn in lfi.horns[freq]:
+            for hornType in lfi.hornTypes:
+                gains[str(horn) + hornType] = get_gain(args, freq, horn, hornType, pid, obt, gainsFile)
+
+        #the auxiliary numbers the pid is made from, beyond those of the file
+        pidProvenance = {'pid':pid, 'samples':[pid_start, pid_end], 'time':[exFile['Time/MJD'][pid_start], obt, exFile['Time/SCET'][pid_start]], 'vsun':[velFile[1].data.xvel[velIndex], velFile[1].data.yvel[velIndex], velFile[1].data.zvel[velIndex]], 'satpos':posArray[1:4, posIndex], 'gains':gains}
+        if comm_tod.pid_current(pid, pidProvenance):
+            continue
+        if pid in comm_tod.pids:
+            print('Converting pid ' + str(pid) + ' of ' + comm_tod.outName + ' again')
+            comm_tod.remove_pid(pid)
+
+        comm_tod.begin_chunk(pid)
 
         #common fields per pid
         prefix = str(pid).zfill(6) + '/common'
@@ -191,7 +291,6 @@ def make_od(comm_tod, freq, od, args):
         comm_tod.add_field(prefix + '/ntod', [pid_end - pid_start])
 
         #velocity field
-        velIndex = np.where(velFile[1].data.scet > exFile['Time/SCET'][pid_start])[0][0]
         #rotate from ecliptic to galactic 
         r = hp.Rotator(coord=['E', 'G'])
         comm_tod.add_field(prefix + '/vsun', r([velFile[1].data.xvel[velIndex], velFile[1].data.yvel[velIndex], velFile[1].data.zvel[velIndex]])) 
@@ -201,16 +300,11 @@ def make_od(comm_tod, freq, od, args):
         comm_tod.add_attribute(prefix + '/vsun','coords','galactic')
 
         #satelite position
-        posIndex = np.where(posArray[0] > exFile['Time/MJD'][pid_start])[0][0]
         comm_tod.add_field(prefix + '/satpos', [posArray[1][posIndex], posArray[2][posIndex], posArray[3][posIndex]])
         #add metadata
         comm_tod.add_attribute(prefix + '/satpos','index','X, Y, Z')
         comm_tod.add_attribute(prefix + '/satpos','coords','heliocentric')
 
-        #open per freq npipe gains file if required
-        if args.gains_dir is not None and "npipe" in args.gains_dir:#this is a shitty test
-            gainsFile = fits.open(os.path.join(args.gains_dir, 'gains_0' + str(freq) + '_iter01.fits'))
-
         #per detector fields
         for horn in lfi.horns[freq]:
             fileName = h5py.File(os.path.join(args.planck_dir, 'LFI_0' + str(freq) + '_' + str(horn) + '_L2_002_OD' + str(od).zfill(4) +'.h5'), 'r')
@@ -226,7 +320,10 @@ def make_od(comm_tod, freq, od, args):
                 flagArray = fileName[str(horn) + hornType + '/FLAG'][pid_start:pid_end]
                 
                 if (len(flagArray) > 0):
-                    comm_tod.add_field(prefix + '/flag', flagArray, compArr)
+                    flagComp = compArr
+                    if not args.no_compress and args.flag_compression != 'huffman':
+                        flagComp = [[args.flag_compression, {}]]
+                    comm_tod.add_field(prefix + '/flag', flagArray, flagComp, stats={'flagMask':lfi.flagMask} if args.stats else None)
 
                 #make pixel number
                 newTheta, newPhi = r(fileName[str(horn) + hornType + '/THETA'][pid_start:pid_end], fileName[str(horn) + hornType + '/PHI'][pid_start:pid_end])
@@ -237,9 +334,9 @@ def make_od(comm_tod, freq, od, args):
                     outAng = lfi.ring_outer_product(newTheta, newPhi)
                     comm_tod.add_field(prefix + '/outP', data=outAng)
                     if(args.no_compress):
-                        comm_tod.add_field(prefix+'/theta', data=newTheta)
-                        comm_tod.add_field(prefix+'/phi', data=newPhi) 
-                    comm_tod.add_field(prefix + '/pix', pixels, compArr)
+                        comm_tod.add_field(prefix+'/theta', data=newTheta, compression=hdf5Comp)
+                        comm_tod.add_field(prefix+'/phi', data=newPhi, compression=hdf5Comp) 
+                    comm_tod.add_field(prefix + '/pix', pixels, compArr, stats={'unique':True} if args.stats else None)
 
 
                 #make pol angle
@@ -250,28 +347,10 @@ def make_od(comm_tod, freq, od, args):
                     compArray = None
                     if not args.no_compress:
                         compArray = [lfi.psiDigitize, lfi.huffman]            
-                    comm_tod.add_field(prefix + '/psi', psiArray, compArray)
+                    comm_tod.add_field(prefix + '/psi', psiArray, compArray, stats={} if args.stats else None)
                 
                 #scalars
-                
-                gain = 1
-                #make gain
-                if args.gains_dir is not None and "npipe" in args.gains_dir:#this is a shitty test
-                    baseGain = fits.getdata(os.path.join(args.gains_dir, 'C0' + str(freq) + '-0000-DX11D-20150209_uniform.fits'),extname='LFI' + str(horn) + hornType)[0][0]
-                    gainArr = gainsFile['LFI' + str(horn) + hornType].data.cumulative
-                    obtArr = (1e-9 * pow(2,16)) * gainsFile[1].data.OBT
-                    gainI = np.where(obtArr <= obt)[0][-1]
-
-                    gain = np.array([1.0/(baseGain * gainArr[gainI])])
-
-
-                elif args.gains_dir is not None:
-                    gainFile = fits.open(os.path.join(args.gains_dir, 'LFI_0' + str(freq) + '_LFI' + str(horn) + hornType + '_001.fits'))
-                    gain=1.0/gainFile[1].data.GAIN[np.where(gainFile[1].data.PID == pid)]
-                    gainFile.close()
-                #TODO: fix this
-                if(type(gain) is int or gain.size == 0):
-                    gain = [0.06]
+                gain = gains[str(horn) + hornType]
          
                 #make white noise
                 sigma0 = rimo[1].data.field('net')[rimo_i] * math.sqrt(fsamp)
@@ -294,14 +373,63 @@ def make_od(comm_tod, freq, od, args):
                 todSigma[1]['sigma0'] = sigma0*gain[0]
                 compArray = [lfi.todDytpe, todSigma, lfi.huffTod]
                 if(args.no_compress or args.no_compress_tod):
-                    compArray = [lfi.todDytpe] 
-                comm_tod.add_field(prefix + '/tod', tod, compArray)
+                    compArray = [lfi.todDytpe] + (hdf5Comp or [])
+                comm_tod.add_field(prefix + '/tod', tod, compArray, stats={} if args.stats else None)
 
                 #undifferenced data? TODO
         
-        comm_tod.finalize_chunk(pid, loadBalance=outAng)
+        comm_tod.finalize_chunk(pid, loadBalance=outAng, provenance=pidProvenance)
     comm_tod.finalize_file()
 
+#returns the gain of a detector for pid
+def get_gain(args, freq, horn, hornType, pid, obt, gainsFile):
+    gain = 1
+    #make gain
+    if gainsFile is not None:
+        baseGain = fits.getdata(os.path.join(args.gains_dir, 'C0' + str(freq) + '-0000-DX11D-20150209_uniform.fits'),extname='LFI' + str(horn) + hornType)[0][0]
+        gainArr = gainsFile['LFI' + str(horn) + hornType].data.cumulative
+        obtArr = (1e-9 * pow(2,16)) * gainsFile[1].data.OBT
+        gainI = np.where(obtArr <= obt)[0][-1]
+
+        gain = np.array([1.0/(baseGain * gainArr[gainI])])
+
+
+    elif args.gains_dir is not None:
+        gainFile = fits.open(os.path.join(args.gains_dir, 'LFI_0' + str(freq) + '_LFI' + str(horn) + hornType + '_001.fits'))
+        gain=1.0/gainFile[1].data.GAIN[np.where(gainFile[1].data.PID == pid)]
+        gainFile.close()
+    #TODO: fix this
+    if(type(gain) is int or gain.size == 0):
+        gain = [0.06]
+    return gain
+
+#returns what the file of freq and od is made from: the level 2 files of
+#every horn, the rimo rows of its detectors, the conversion options,
+#compression chains and shared dictionaries, and the conversion code. The
+#numbers that vary by pid are in the provenance of the pids instead
+def od_provenance(comm_tod, freq, od, rimo, args):
+    inputs = []
+    for horn in lfi.horns[freq]:
+        path = os.path.join(args.planck_dir, 'LFI_0' + str(freq) + '_' + str(horn) + '_L2_002_OD' + str(od).zfill(4) +'.h5')
+        inputs.append(tod.file_provenance(path, args.hash_inputs) if os.path.exists(path) else {'name':os.path.basename(path)})
+
+    rimoRows = {}
+    for horn in lfi.horns[freq]:
+        for hornType in lfi.hornTypes:
+            rimo_i = np.where(rimo[1].data.field('detector').flatten() == 'LFI' + str(horn) + hornType)
+            rimoRows[str(horn) + hornType] = {name:rimo[1].data.field(name)[rimo_i] for name in ['f_samp', 'psi_pol', 'net', 'f_knee', 'alpha']}
+
+    options = {name:getattr(args, name) for name in ['version', 'no_compress', 'no_compress_tod', 'hdf5_filter', 'flag_compression', 'max_escape', 'stats']}
+    compression = {'huffman':lfi.huffman, 'huffTod':lfi.huffTod, 'todDtype':lfi.todDytpe, 'todSigma':lfi.todSigma[1]['nsigma'], 'psiDigitize':lfi.psiDigitize}
+    #the shared dictionaries are trained on a random sample of ods unless
+    #saved ones are reused, and the pids of a file must all link to the same
+    for (dictFreq, dictNum), (h, maxEscape) in comm_tod.sharedDicts.items():
+        if dictFreq == freq:
+            compression['shared' + str(dictNum)] = comm_tod.compute_version({'symbols':h.symbols, 'left':h.left_nodes, 'right':h.right_nodes, 'max':h.node_max})
+
+    code = tod.source_digest([os.path.abspath(__file__), sys.modules[lfi.__module__].__file__] + tod.tod_sources())
+    return {'inputs':inputs, 'rimo':rimoRows, 'options':options, 'compression':compression, 'code':code}
+
 
 if __name__ == '__main__':
     main()
@@ -19,11 +19,11 @@
 #
 #================================================================================
 
+from commander_tools.tod_tools import commander_tod as tod
 import numpy as np
 import matplotlib.pyplot as plt
+import multiprocessing as mp
 import argparse
-import h5py
-import os
 
 def main():
 
@@ -37,41 +37,43 @@ def main():
 
     parser.add_argument('--ods', type=int, nargs=2, action='store', help='ods to plot from', default=[91, 1604])
 
+    parser.add_argument('--num-procs', type=int, action='store', default=1, help='number of processes reading the files')
+
+    parser.add_argument('--cache-dir', type=str, action='store', default=None, help='directory to keep the extracted series in for later runs')
+
     in_args = parser.parse_args()
 
     freqs = {18:70, 19:70, 20:70, 21:70, 22:70, 23:70, 24:44, 25:44, 26:44, 27:30, 28:30}
     
-    used_freqs = []
+    used_freqs = {}
     for det in in_args.dets:
         freq = freqs[int(det[0:-1])]
-        if not freq in used_freqs:
-            used_freqs.append(freq)
+        used_freqs.setdefault(freq, []).append(det)
+
+    print(list(used_freqs.keys()))
+
+    scalars = ['gain', 'sigma0', 'fknee', 'alpha']
+    comm_tod = tod.commander_tod(in_args.data_dir)
+    pool = mp.Pool(processes=in_args.num_procs) if in_args.num_procs > 1 else None
 
     fields = {}
     for field in in_args.fields:
-        for det in in_args.dets:
-            fields[field+det] = []
-
-    print(used_freqs)
-
-    for od in range(in_args.ods[0], in_args.ods[1]):
-        for freq in used_freqs:
-            f = h5py.File(os.path.join(in_args.data_dir, 'LFI_0' + str(freq) + '_' + str(od).zfill(6) + '.h5'))
-            for group in f['/']:
-                if 'common' not in group:
-                    for field in in_args.fields:
-                        newfield = field
-                        scalars = ['gain', 'sigma0', 'fknee', 'alpha']
-                        if field in scalars:
-                            newfield = 'scalars'
-                            
-                        for det in in_args.dets:
-                            #print('/' + group + '/' + det + '/' + newfield)
-                            data = f['/' + group + '/' + det + '/' + newfield]
-                            if newfield is 'scalars':
-                                fields[field+det].append(data[scalars.index(field)])
-                            else:
-                                fields[field+det].append(data)                
+        newfield = field
+        if field in scalars:
+            newfield = 'scalars'
+        for freq, dets in used_freqs.items():
+            pids, series, offsets = comm_tod.read_across_files(newfield, dets, range(in_args.ods[0], in_args.ods[1]), freq=freq, pool=pool, cacheDir=in_args.cache_dir)
+            for det in dets:
+                if newfield == 'scalars':
+                    #pids without scalars have no rows
+                    starts = offsets[det][:-1][np.diff(offsets[det]) > 0]
+                    fields[field+det] = series[det][starts + scalars.index(field)]
+                else:
+                    fields[field+det] = series[det]
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     for field in in_args.fields:
         plt.figure()
@@ -0,0 +1,70 @@
+#================================================================================
+#
+# Copyright (C) 2020 Institute of Theoretical Astrophysics, University of Oslo.
+#
+# This file is part of Commander3.
+#
+# Commander3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Commander3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Commander3. If not, see <https://www.gnu.org/licenses/>.
+#
+#================================================================================
+
+# Reports how evenly the pids in the scan catalogs of a directory of tod
+# files are spread over a number of commander processes: as commander
+# assigns them with every weight 1, as it assigns them with the cost weights
+# make_filelists writes, and as the assignment of write_assignment does
+
+from commander_tools.tod_tools import commander_tod as tod
+from commander_tools.tod_tools import balance
+import argparse
+import numpy as np
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('data_dir', type=str, action='store', help='path to the tod files and their catalogs')
+
+    parser.add_argument('--freqs', type=int, nargs='+', default=[30, 44, 70], help='which frequencies to report on')
+
+    parser.add_argument('--ranks', type=int, nargs='+', default=[64], help='numbers of processes to report on')
+
+    parser.add_argument('--write-assignment', action='store_true', default=False, help='also write the assignments of the pids to every number of processes')
+
+    in_args = parser.parse_args()
+
+    comm_tod = tod.commander_tod(in_args.data_dir)
+
+    for freq in in_args.freqs:
+        try:
+            catalog = comm_tod.load_catalog(freq)
+        except OSError:
+            print(str(freq) + ' GHz: no catalog')
+            continue
+        costs = balance.scan_costs(catalog)
+        weights = costs/np.mean(costs) if len(costs) > 0 and np.mean(costs) > 0 else np.ones(len(costs))
+        spinpos = np.array([catalog['load0'], catalog['load1']]).T
+        print(str(freq) + ' GHz: ' + str(len(costs)) + ' pids, cost ' + '{:.3f}'.format(np.sum(costs)/1e9) + ' GB decoded, largest pid ' + '{:.2f}'.format(np.max(weights) if len(weights) > 0 else 0) + ' x the mean')
+        for ranks in in_args.ranks:
+            if ranks > len(costs):
+                print('  ' + str(ranks) + ' processes: fewer pids than processes')
+                continue
+            assignments = [('commander, unit weights', balance.commander_assignment(np.ones(len(costs)), spinpos, ranks)), ('commander, cost weights', balance.commander_assignment(weights, spinpos, ranks)), ('largest first', balance.lpt_assignment(weights, ranks))]
+            for name, assignment in assignments:
+                loads = balance.rank_loads(costs, assignment, ranks)
+                print('  ' + str(ranks) + ' processes, ' + name + ': max/mean ' + '{:.3f}'.format(np.max(loads)/np.mean(loads)) + ', min/mean ' + '{:.3f}'.format(np.min(loads)/np.mean(loads)))
+            if in_args.write_assignment:
+                comm_tod.write_assignment(freq, catalog['pid'], weights, ranks)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+#================================================================================
+#
+# Copyright (C) 2020 Institute of Theoretical Astrophysics, University of Oslo.
+#
+# This file is part of Commander3.
+#
+# Commander3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Commander3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Commander3. If not, see <https://www.gnu.org/licenses/>.
+#
+#================================================================================
+
+# Benchmarks writing and reading synthetic LFI and WMAP shaped pids through
+# commander_tod, reporting for every field the encode and decode throughput,
+# the peak memory and the compression ratio, optionally as json for tracking
+# the numbers across commits
+
+from commander_tools.tod_tools import commander_tod as tod
+import argparse
+import healpy as hp
+import numpy as np
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+#scan parameters of the synthetic pids. alpha is the opening angle between
+#the spin axis and the line of sight, and the spin axis of wmap precesses at
+#22.5 degrees from the anti-sun direction
+instruments = {
+    'lfi':{'freq':70, 'nside':1024, 'fsamp':78.0, 'spin':60.0, 'alpha':85.0, 'precession':None, 'npsi':4096, 'dets':['18M', '18S', '19M', '19S']},
+    'wmap':{'freq':23, 'nside':256, 'fsamp':1/0.0128, 'spin':129.0, 'alpha':70.5, 'precession':3600.0, 'npsi':2048, 'dets':['K113', 'K114', 'K123', 'K124']},
+}
+
+fields = ['pix', 'psi', 'flag', 'tod']
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--instruments', type=str, nargs='+', default=list(instruments.keys()), help='which instruments to synthesize pids for')
+
+    parser.add_argument('--nsamp', type=int, action='store', default=1<<18, help='number of samples per detector')
+
+    parser.add_argument('--nrep', type=int, action='store', default=3, help='number of timing repetitions, the fastest is reported')
+
+    parser.add_argument('--seed', type=int, action='store', default=0, help='random seed for the synthetic streams')
+
+    parser.add_argument('--threads', type=int, action='store', default=1, help='number of threads commander_tod encodes a pid with')
+
+    parser.add_argument('--coder', type=str, action='store', default='huffman', help='entropy coder of the compressed fields, huffman, one of commander_tod.entropyCoders, or none for the fields of a --no-compress conversion')
+
+    parser.add_argument('--hdf5-filter', type=str, action='store', default=None, help='hdf5 filter, gzip or lzf, applied to the fields stored as arrays (with --coder none or to flags)')
+
+    parser.add_argument('--shuffle', action='store_true', default=False, help='shuffle the bytes of the samples before the hdf5 filter')
+
+    parser.add_argument('--chunks', type=int, action='store', default=None, help='samples per hdf5 chunk, chosen by h5py by default')
+
+    parser.add_argument('--flag-compression', type=str, action='store', default=None, help='compression of the flag field, one of commander_tod.flagSteps, the entropy coder by default')
+
+    parser.add_argument('--json', type=str, action='store', default=None, help='path to write the results to as json')
+
+    parser.add_argument('--out-dir', type=str, action='store', default=None, help='directory for the temporary files, a fresh temporary directory by default')
+
+    in_args = parser.parse_args()
+
+    outDir = in_args.out_dir
+    if outDir is None:
+        outDir = tempfile.mkdtemp()
+    else:
+        os.makedirs(outDir, exist_ok=True)
+
+    hdf5 = None
+    if in_args.hdf5_filter is not None or in_args.shuffle or in_args.chunks is not None:
+        hdf5 = {'filter':in_args.hdf5_filter, 'shuffle':in_args.shuffle, 'chunks':True if in_args.chunks is None else in_args.chunks}
+
+    rng = np.random.default_rng(in_args.seed)
+    results = {}
+    try:
+        for name in in_args.instruments:
+            inst = instruments[name]
+            pid = make_pid(rng, inst, in_args.nsamp)
+            results[name] = {}
+            for field in fields:
+                res = run_field(outDir, inst, field, pid[field], compression(inst, field, in_args.coder, in_args.flag_compression, hdf5), in_args.nrep, in_args.threads)
+                results[name][field] = res
+                print(name + ' ' + field + ': ratio ' + '{:.2f}'.format(res['ratio']) + ', ' + '{:.3f}'.format(res['bits_per_sample']) + ' bits/sample, encode ' + '{:.1f}'.format(res['encode_mb_s']) + ' MB/s (' + '{:.1f}'.format(res['encode_peak_mb']) + ' MB peak), decode ' + '{:.1f}'.format(res['decode_mb_s']) + ' MB/s (' + '{:.1f}'.format(res['decode_peak_mb']) + ' MB peak)')
+    finally:
+        if in_args.out_dir is None:
+            shutil.rmtree(outDir)
+
+    if in_args.json is not None:
+        with open(in_args.json, 'w') as f:
+            json.dump({'commit':git_commit(), 'date':datetime.datetime.now().isoformat(), 'args':vars(in_args), 'results':results}, f, indent=2)
+
+#compression steps of a field as used by the conversion scripts, ending in
+#the entropy coder coder or, for flags, in flagComp if given, and followed
+#by an hdf5 step with the arguments hdf5 for fields stored as arrays
+def compression(inst, field, coder, flagComp=None, hdf5=None):
+    if field == 'flag' and flagComp is not None:
+        comp = [[flagComp, {}]]
+    elif coder == 'none':
+        #as written by a --no-compress conversion
+        comp = [['dtype', {'dtype':'f4'}]] if field == 'tod' else []
+    else:
+        if coder == 'huffman':
+            entropy = ['huffman', {'dictNum':2 if field == 'tod' else 1}]
+        else:
+            entropy = [coder, {}]
+        if field == 'psi':
+            return [['digitize', {'min':0, 'max':2*np.pi, 'nbins':inst['npsi']}], entropy]
+        if field == 'tod':
+            return [['dtype', {'dtype':'f4'}], ['sigma', {'sigma0':1e-3, 'nsigma':100}], entropy]
+        return [entropy]
+    if hdf5 is not None:
+        comp.append(['hdf5', hdf5])
+    return comp if len(comp) > 0 else None
+
+#returns the fields of every detector of a pid of nsamp samples: pixels of a
+#ring scan, polarization angles that follow the spin phase, flags that are
+#clear except for a few stretches, and white noise tods with a slow drift
+def make_pid(rng, inst, nsamp):
+    t = np.arange(nsamp)/inst['fsamp']
+    spin = 2*np.pi*t/inst['spin']
+    alpha = np.radians(inst['alpha'])
+
+    if inst['precession'] is None:
+        #spin axis in the ecliptic, moving by a degree per day
+        axisTheta = np.full(nsamp, np.pi/2)
+        axisPhi = np.radians(t/86400.)
+    else:
+        prec = 2*np.pi*t/inst['precession']
+        axisTheta = np.pi/2 + np.radians(22.5)*np.sin(prec)
+        axisPhi = np.radians(t/86400.) + np.radians(22.5)*np.cos(prec)
+
+    axis = np.array(hp.ang2vec(axisTheta, axisPhi))
+    #two unit vectors orthogonal to the spin axis
+    u = np.cross(axis, [0, 0, 1])
+    u /= np.linalg.norm(u, axis=1)[:,None]
+    v = np.cross(axis, u)
+
+    pid = {field:{} for field in fields}
+    for i, det in enumerate(inst['dets']):
+        offset = np.radians(0.5*i)
+        vec = np.cos(alpha)*axis + np.sin(alpha)*(np.cos(spin + offset)[:,None]*u + np.sin(spin + offset)[:,None]*v)
+        pid['pix'][det] = hp.vec2pix(inst['nside'], vec[:,0], vec[:,1], vec[:,2])
+        pid['psi'][det] = np.mod(spin + offset + np.pi/4*(i % 2) + rng.normal(0, 1e-3, nsamp), 2*np.pi)
+
+        starts = rng.integers(0, nsamp, max(1, nsamp//20000))
+        edges = np.zeros(nsamp + 200, dtype=np.int64)
+        np.add.at(edges, starts, 1)
+        np.add.at(edges, starts + 200, -1)
+        pid['flag'][det] = np.int32(np.cumsum(edges)[:nsamp] > 0)*8
+
+        drift = np.cumsum(rng.normal(0, 1e-5, nsamp))
+        pid['tod'][det] = rng.normal(0, 1e-3, nsamp) + drift + 1e-3*np.sin(spin)
+    return pid
+
+#writes field for every detector of one pid to a file of its own and reads
+#it back, returning the fastest times of nrep repetitions together with the
+#peak memory allocated while doing so
+def run_field(outDir, inst, field, data, compArr, nrep, threads):
+    raw = sum(d.nbytes for d in data.values())
+    nsamp = sum(len(d) for d in data.values())
+
+    def write():
+        comm_tod = tod.commander_tod(outDir, 1, None, True, threads=threads)
+        comm_tod.init_file(inst['freq'], 1, mode='w')
+        for det, d in data.items():
+            comm_tod.add_field('000001/' + det + '/' + field, d, compArr)
+        comm_tod.finalize_chunk(1)
+        comm_tod.outFile.close()
+
+    def read():
+        comm_tod = tod.commander_tod(outDir, 1)
+        comm_tod.init_file(inst['freq'], 1)
+        out = [np.asarray(comm_tod.load_field('/000001/' + det + '/' + field)) for det in data.keys()]
+        comm_tod.outFile.close()
+        return out
+
+    t_enc, peak_enc, _ = profile(write, nrep)
+    t_dec, peak_dec, out = profile(read, nrep)
+
+    for d, o in zip(data.values(), out):
+        if field in ['pix', 'flag'] and not np.array_equal(d, o):
+            raise ValueError('Round trip of ' + field + ' failed')
+
+    comm_tod = tod.commander_tod(outDir, 1)
+    comm_tod.init_file(inst['freq'], 1)
+    stored = 0
+    for name in stored_datasets(comm_tod.outFile):
+        stored += comm_tod.outFile[name].id.get_storage_size()
+    comm_tod.outFile.close()
+
+    return {'raw_bytes':raw, 'stored_bytes':stored, 'ratio':raw/stored, 'bits_per_sample':8*stored/nsamp, 'encode_mb_s':raw/1e6/t_enc, 'decode_mb_s':raw/1e6/t_dec, 'encode_peak_mb':peak_enc/1e6, 'decode_peak_mb':peak_dec/1e6}
+
+#names of the datasets in the file that are not metadata
+def stored_datasets(outFile):
+    names = []
+    def visit(name, obj):
+        if hasattr(obj, 'shape') and not name.startswith('common') and not name.endswith('load'):
+            names.append(name)
+    outFile.visititems(visit)
+    return names
+
+#tracing the allocations slows down code making many small ones, so the peak
+#memory is measured in a run of its own after the timed ones
+def profile(func, nrep):
+    times = []
+    for i in range(nrep):
+        t0 = time.time()
+        func()
+        times.append(time.time() - t0)
+    tracemalloc.start()
+    out = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak, out
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#================================================================================
+#
+# Copyright (C) 2020 Institute of Theoretical Astrophysics, University of Oslo.
+#
+# This file is part of Commander3.
+#
+# Commander3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Commander3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Commander3. If not, see <https://www.gnu.org/licenses/>.
+#
+#================================================================================
+
+# Rebuilds the scan catalogs of a directory of tod files by reading every
+# file on a pool of processes, and optionally the filelists from them, or
+# summarizes the catalogs that are there
+
+from commander_tools.tod_tools import commander_tod as tod
+import multiprocessing as mp
+import numpy as np
+import argparse
+import glob
+import os
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('data_dir', type=str, action='store', help='path to the tod files')
+
+    parser.add_argument('--freqs', type=int, nargs='+', default=[30, 44, 70], help='which frequencies to catalog')
+
+    parser.add_argument('--num-procs', type=int, action='store', default=1, help='number of processes reading the files')
+
+    parser.add_argument('--produce-filelist', action='store_true', default=False, help='write the filelists from the rebuilt catalogs')
+
+    parser.add_argument('--ranks', type=int, nargs='+', default=[], help='also write the assignments of the pids to these numbers of commander processes with the filelists')
+
+    parser.add_argument('--summary', action='store_true', default=False, help='only summarize the existing catalogs')
+
+    in_args = parser.parse_args()
+
+    comm_tod = tod.commander_tod(in_args.data_dir)
+
+    if not in_args.summary:
+        pool = mp.Pool(processes=in_args.num_procs)
+        for freq in in_args.freqs:
+            ods = file_ods(in_args.data_dir, freq)
+            rows = []
+            for fileRows in pool.imap(tod.scan_catalog_file, [(in_args.data_dir, freq, od) for od in ods]):
+                rows += fileRows
+            comm_tod.write_catalog(freq, rows, replace=True)
+            print('Cataloged ' + str(len(rows)) + ' pids in ' + str(len(ods)) + ' files at ' + str(freq) + ' GHz')
+        pool.close()
+        pool.join()
+
+        if in_args.produce_filelist:
+            comm_tod.make_filelists(in_args.freqs, in_args.ranks)
+
+    for freq in in_args.freqs:
+        summarize(comm_tod, freq)
+
+#ods of the files of freq in dataDir, from their names
+def file_ods(dataDir, freq):
+    prefix = 'LFI_0' + str(freq) + '_'
+    return sorted(int(os.path.basename(name)[len(prefix):-3]) for name in glob.glob(os.path.join(dataDir, prefix + '[0-9]*.h5')))
+
+def summarize(comm_tod, freq):
+    try:
+        catalog = comm_tod.load_catalog(freq)
+    except OSError:
+        print(str(freq) + ' GHz: no catalog')
+        return
+    pids = catalog['pid']
+    gaps = np.nonzero(np.diff(pids) > 1)[0]
+    duplicates = pids[1:][np.diff(pids) == 0]
+    print(str(freq) + ' GHz: ' + str(len(pids)) + ' pids in ' + str(len(np.unique(catalog['fileName']))) + ' files, ' + '{:.3f}'.format(np.sum(catalog['nbytes'])/1e9) + ' GB, ' + str(np.sum(catalog['ntod'])) + ' samples per detector')
+    if len(pids) > 0:
+        print('  pids ' + str(pids[0]) + ' to ' + str(pids[-1]) + ', mjd ' + '{:.3f}'.format(np.nanmin(catalog['mjdStart'])) + ' to ' + '{:.3f}'.format(np.nanmax(catalog['mjdEnd'])))
+    print('  compression: ' + ', '.join(sorted(set(','.join(catalog['compression']).split(',')) - {''})))
+    if len(gaps) > 0:
+        print('  ' + str(len(gaps)) + ' gaps in the pids, the first after pid ' + str(pids[gaps[0]]))
+    if len(duplicates) > 0:
+        print('  pids in more than one file: ' + ', '.join(str(pid) for pid in np.unique(duplicates)))
+
+if __name__ == '__main__':
+    main()
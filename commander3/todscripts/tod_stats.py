@@ -0,0 +1,117 @@
+#================================================================================
+#
+# Copyright (C) 2020 Institute of Theoretical Astrophysics, University of Oslo.
+#
+# This file is part of Commander3.
+#
+# Commander3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Commander3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Commander3. If not, see <https://www.gnu.org/licenses/>.
+#
+#================================================================================
+
+# Checks a directory of tod files from the summary statistics stored with
+# every pid (lfitohdf5 --stats), without decoding any field: summarizes every
+# field and lists the pids whose statistics stand out from those of the same
+# detector, and those flagged more than a given fraction
+
+from commander_tools.tod_tools import commander_tod as tod
+from tod_catalog import file_ods
+import argparse
+import multiprocessing as mp
+import numpy as np
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('data_dir', type=str, action='store', help='path to the tod files')
+
+    parser.add_argument('--freqs', type=int, nargs='+', default=[30, 44, 70], help='which frequencies to check')
+
+    parser.add_argument('--num-procs', type=int, action='store', default=1, help='number of processes reading the files')
+
+    parser.add_argument('--columns', type=str, nargs='+', default=['mean', 'var', 'unique'], help='statistics compared between the pids of a detector')
+
+    parser.add_argument('--nsigma', type=float, action='store', default=5.0, help='distance from the median of a detector, in robust standard deviations, beyond which a statistic of a pid is an outlier')
+
+    parser.add_argument('--max-flagged', type=float, action='store', default=0.2, help='fraction of flagged samples beyond which a pid is listed')
+
+    parser.add_argument('--max-listed', type=int, action='store', default=20, help='number of outliers listed per frequency')
+
+    in_args = parser.parse_args()
+
+    pool = mp.Pool(processes=in_args.num_procs)
+    for freq in in_args.freqs:
+        ods = file_ods(in_args.data_dir, freq)
+        rows = []
+        missing = 0
+        for res in pool.imap(tod.read_file_stats, [(in_args.data_dir, freq, od) for od in ods]):
+            if res is None:
+                continue
+            for pid, table in zip(*res):
+                if table is None:
+                    missing += 1
+                    continue
+                for row in table:
+                    rows.append((pid, row['field'].decode(), row))
+        npids = len(set(row[0] for row in rows))
+        print(str(freq) + ' GHz: ' + str(npids) + ' pids with statistics in ' + str(len(ods)) + ' files, ' + str(missing) + ' without')
+        check(rows, in_args)
+    pool.close()
+    pool.join()
+
+#summarizes the statistics of every field over the pids and detectors, and
+#lists the outliers
+def check(rows, args):
+    fields = {}
+    for pid, name, row in rows:
+        fields.setdefault(name.split('/')[-1], []).append((pid, name, row))
+
+    outliers = []
+    for field, fieldRows in sorted(fields.items()):
+        table = {column:np.array([row[column] for pid, name, row in fieldRows]) for column in ['count', 'min', 'max', 'flagged'] + args.columns}
+        line = '  ' + field + ': ' + str(np.sum(table['count'])) + ' samples, min ' + '{:.6g}'.format(np.min(table['min'])) + ', max ' + '{:.6g}'.format(np.max(table['max']))
+        for column in args.columns + ['flagged']:
+            values = table[column]
+            computed = values >= 0 if column == 'unique' else ~np.isnan(values)
+            if np.any(computed):
+                line += ', median ' + column + ' ' + '{:.6g}'.format(np.median(values[computed]))
+        print(line)
+
+        #every detector is compared with itself, as their noise differs
+        dets = np.array([name.rpartition('/')[0] for pid, name, row in fieldRows])
+        pids = np.array([pid for pid, name, row in fieldRows])
+        for det in np.unique(dets):
+            rowsDet = dets == det
+            for column in args.columns:
+                values = table[column][rowsDet].astype(np.float64)
+                computed = values >= 0 if column == 'unique' else ~np.isnan(values)
+                if np.sum(computed) < 3:
+                    continue
+                median = np.median(values[computed])
+                sigma = 1.4826*np.median(np.abs(values[computed] - median))
+                if sigma == 0:
+                    continue
+                z = (values - median)/sigma
+                for i in np.nonzero(computed & (np.abs(z) > args.nsigma))[0]:
+                    outliers.append((abs(z[i]), pids[rowsDet][i], det, column, values[i], 'z ' + '{:.1f}'.format(z[i])))
+            flagged = table['flagged'][rowsDet]
+            for i in np.nonzero(flagged > args.max_flagged)[0]:
+                outliers.append((np.inf, pids[rowsDet][i], det, 'flagged', flagged[i], 'above ' + str(args.max_flagged)))
+
+    print('  ' + str(len(outliers)) + ' outliers' + (', the largest:' if len(outliers) > 0 else ''))
+    for score, pid, det, column, value, reason in sorted(outliers, key=lambda outlier: -outlier[0])[:args.max_listed]:
+        print('    pid ' + str(pid) + ' ' + det + ' ' + column + ' ' + '{:.6g}'.format(value) + ' (' + reason + ')')
+
+if __name__ == '__main__':
+    main()
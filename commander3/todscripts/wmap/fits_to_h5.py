@@ -31,8 +31,9 @@ from glob import glob
 import multiprocessing as mp
 from multiprocessing import Pool
 from joblib import Parallel, delayed
+from concurrent.futures import ThreadPoolExecutor
 
-import huffman
+from commander_tools.tod_tools import huffman
 
 
 from scipy.interpolate import interp1d
@@ -121,14 +122,8 @@ def write_file_parallel(file_ind, i, obsid, obs_ind, daflags, TODs, gain_guesses
             pixArray_B[2].append(delta)
 
 
-    h_A = huffman.Huffman("", nside)
-    h_A.GenerateCode(pixArray_A)
-
-    h_B = huffman.Huffman("", nside)
-    h_B.GenerateCode(pixArray_B)
-
-    h_Tod = huffman.Huffman("", nside)
-    h_Tod.GenerateCode(todArray)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        h_A, h_B, h_Tod = pool.map(make_huffman, [pixArray_A, pixArray_B, todArray], [nside]*3)
 
     huffarray_A = np.append(np.append(np.array(h_A.node_max), h_A.left_nodes), h_A.right_nodes)
     huffarray_B = np.append(np.append(np.array(h_B.node_max), h_B.left_nodes), h_B.right_nodes)
@@ -263,6 +258,11 @@ def write_file_parallel(file_ind, i, obsid, obs_ind, daflags, TODs, gain_guesses
         file_list.write(f'{str(obs_ind).zfill(6)}\t"{file_out}"\t1\t0\t0\n')
     return
 
+def make_huffman(deltas, nside):
+    h = huffman.Huffman("", nside)
+    h.GenerateTree(deltas)
+    return h
+
 def coord_trans(pos_in, coord_in, coord_out, lonlat=False):
     r = hp.rotator.Rotator(coord=[coord_in, coord_out])
     pos_out = r(pos_in.T).T
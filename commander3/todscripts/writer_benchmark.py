@@ -0,0 +1,173 @@
+#================================================================================
+#
+# Copyright (C) 2020 Institute of Theoretical Astrophysics, University of Oslo.
+#
+# This file is part of Commander3.
+#
+# Commander3 is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Commander3 is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Commander3. If not, see <https://www.gnu.org/licenses/>.
+#
+#================================================================================
+
+# Times writing a synthetic 70 GHz LFI od, with the fields and attributes
+# lfitohdf5 writes for every pid, through commander_tod one field at a time
+# and buffered per pid with begin_chunk/write_chunk, optionally also handing
+# the buffered pids to a background writer thread or gathering the summary
+# statistics of the fields
+
+from commander_tools.tod_tools import commander_tod as tod
+from commander_tools.tod_tools.lfi import lfi
+import argparse
+import numpy as np
+import shutil
+import tempfile
+import time
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--npids', type=int, action='store', default=24, help='number of pids in the od')
+
+    parser.add_argument('--nsamp', type=int, action='store', default=283000, help='number of samples per detector and pid')
+
+    parser.add_argument('--nrep', type=int, action='store', default=3, help='number of timing repetitions, the fastest is reported')
+
+    parser.add_argument('--seed', type=int, action='store', default=0, help='random seed for the synthetic streams')
+
+    parser.add_argument('--no-compress', action='store_true', default=False, help='write the fields uncompressed, which leaves only the cost of creating them')
+
+    parser.add_argument('--write-queue', type=int, action='store', default=0, help='also time buffered writing by a background thread with this many pids queued')
+
+    parser.add_argument('--stats', action='store_true', default=False, help='also time gathering the summary statistics of the flag, pix, psi and tod fields, as lfitohdf5 --stats does')
+
+    parser.add_argument('--memory', action='store_true', default=False, help='also report the growth of the peak resident memory while writing a single pid, on linux')
+
+    parser.add_argument('--out-dir', type=str, action='store', default=None, help='directory for the temporary files, a fresh temporary directory by default')
+
+    in_args = parser.parse_args()
+
+    outDir = in_args.out_dir if in_args.out_dir is not None else tempfile.mkdtemp()
+    rng = np.random.default_rng(in_args.seed)
+    dets = [str(horn) + hornType for horn in lfi.horns[70] for hornType in lfi.hornTypes]
+    fields = make_fields(rng, dets, in_args.nsamp)
+
+    #name, whether pids are buffered and the pids queued for the writer thread
+    modes = [('per field', False, 0, False), ('buffered', True, 0, False)]
+    if in_args.write_queue > 0:
+        modes.append(('background', True, in_args.write_queue, False))
+    if in_args.stats:
+        modes.append(('buffered with stats', True, 0, True))
+
+    try:
+        times = {}
+        for name, buffered, writeQueue, stats in modes:
+            runs = [write_od(outDir, dets, fields, in_args.npids, buffered, not in_args.no_compress, writeQueue, stats) for i in range(in_args.nrep)]
+            times[name], stats = min(runs, key=lambda run: run[0])
+            print(name + ': ' + '{:.3f}'.format(times[name]) + ' s per od, ' + '{:.2f}'.format(1e3*times[name]/in_args.npids) + ' ms per pid')
+            if buffered:
+                print('    writing ' + '{:.3f}'.format(stats['write']) + ' s, blocked ' + '{:.3f}'.format(stats['blocked']) + ' s, overlap ' + '{:.2f}'.format(stats['overlap']))
+        print('speedup ' + '{:.2f}'.format(times['per field']/times['buffered']))
+        if in_args.write_queue > 0:
+            print('background speedup ' + '{:.2f}'.format(times['buffered']/times['background']))
+        if in_args.stats:
+            print('stats overhead ' + '{:.1f}'.format(100*(times['buffered with stats']/times['buffered'] - 1)) + '%')
+        if in_args.memory:
+            for name, buffered, writeQueue, stats in modes:
+                peak = rss_growth(lambda: write_od(outDir, dets, fields, 1, buffered, not in_args.no_compress, writeQueue, stats))
+                print(name + ': peak rss ' + '{:.1f}'.format(peak/1e6) + ' MB above the data for a pid')
+    finally:
+        if in_args.out_dir is None:
+            shutil.rmtree(outDir)
+
+#returns the per detector fields of a pid, which are written for every pid
+def make_fields(rng, dets, nsamp):
+    fields = {}
+    for det in dets:
+        flag = np.zeros(nsamp, dtype=np.int32)
+        for start in rng.integers(0, nsamp, 10):
+            flag[start:start + 200] = 4
+        fields[det] = {
+            'flag':flag,
+            'pix':np.cumsum(rng.integers(-2, 3, nsamp)) + 6*1024**2,
+            'psi':rng.uniform(0, 2*np.pi, nsamp),
+            'tod':rng.normal(0, 1e-3, nsamp),
+            'outP':rng.normal(0, 1, 2),
+            'scalars':np.array([0.06, 1e-3, 0.02, -1.0]),
+        }
+    return fields
+
+#returns how far the peak resident memory rises above the resident memory
+#before calling func, resetting the peak through /proc/self/clear_refs
+def rss_growth(func):
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    before = proc_status('VmRSS')
+    func()
+    return proc_status('VmHWM') - before
+
+#a memory size from /proc/self/status in bytes
+def proc_status(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key + ':'):
+                return int(line.split()[1])*1024
+    raise KeyError(key)
+
+#returns the seconds taken to write the od and the write_stats
+def write_od(outDir, dets, fields, npids, buffered, compress, writeQueue=0, stats=False):
+    comm_tod = tod.commander_tod(outDir, 1, None, True, writeQueue=writeQueue)
+    t0 = time.time()
+    comm_tod.init_file(70, 1, mode='w')
+    comm_tod.add_field('/common/fsamp', [78.77])
+    comm_tod.add_field('/common/nside', [1024])
+    comm_tod.add_field('/common/det', np.bytes_(', '.join(dets)))
+    comm_tod.add_field('/common/polang', np.zeros(len(dets)))
+    comm_tod.add_attribute('/common/polang', 'index', ', '.join(dets))
+
+    compArr = [lfi.huffman] if compress else None
+    psiComp = [lfi.psiDigitize, lfi.huffman] if compress else None
+    todComp = [lfi.todDytpe, ['sigma', {'sigma0':1e-3, 'nsigma':lfi.ntodsigma}], lfi.huffTod] if compress else [lfi.todDytpe]
+
+    for pid in range(1, npids + 1):
+        if buffered:
+            comm_tod.begin_chunk(pid)
+        prefix = str(pid).zfill(6) + '/common'
+        comm_tod.add_field(prefix + '/time', [55000.0 + pid/24, 1e9*pid, 1e9*pid])
+        comm_tod.add_attribute(prefix + '/time', 'index', 'MJD, OBT, SCET')
+        comm_tod.add_field(prefix + '/ntod', [len(fields[dets[0]]['tod'])])
+        comm_tod.add_field(prefix + '/vsun', [1.0, 2.0, 3.0])
+        comm_tod.add_attribute(prefix + '/vsun', 'index', '[x, y, z]')
+        comm_tod.add_attribute(prefix + '/vsun', 'coords', 'galactic')
+        comm_tod.add_field(prefix + '/satpos', [1.0, 2.0, 3.0])
+        comm_tod.add_attribute(prefix + '/satpos', 'index', 'X, Y, Z')
+        comm_tod.add_attribute(prefix + '/satpos', 'coords', 'heliocentric')
+
+        for det in dets:
+            prefix = str(pid).zfill(6) + '/' + det
+            f = fields[det]
+            comm_tod.add_field(prefix + '/flag', f['flag'], compArr, stats={'flagMask':lfi.flagMask} if stats else None)
+            comm_tod.add_field(prefix + '/outP', data=f['outP'])
+            comm_tod.add_field(prefix + '/pix', f['pix'], compArr, stats={'unique':True} if stats else None)
+            comm_tod.add_field(prefix + '/psi', f['psi'], psiComp, stats={} if stats else None)
+            comm_tod.add_field(prefix + '/scalars', f['scalars'])
+            comm_tod.add_attribute(prefix + '/scalars', 'index', 'gain, sigma0, fknee, alpha')
+            comm_tod.add_field(prefix + '/tod', f['tod'], todComp, stats={} if stats else None)
+
+        comm_tod.finalize_chunk(pid, loadBalance=f['outP'])
+    comm_tod.finalize_file()
+    comm_tod.outFile.close()
+    return time.time() - t0, comm_tod.write_stats()
+
+if __name__ == '__main__':
+    main()